@@ -1,20 +1,61 @@
 #!/usr/bin/env python3
 
-import sys
+import argparse
 from knock import *
 from beatmap import *
 
 if __name__ == "__main__":
-    filename = sys.argv[1]
-    
-    with open(filename) as file:
-        sheet = BeatmapStdSheet()
-        exec(file.read(), dict(), dict(sheet=sheet))
-        beatmap = Beatmap(sheet.audio, sheet.events)
+    parser = argparse.ArgumentParser(description="K-AIKO: sound-control one-line terminal-based rhythm game")
+    parser.add_argument("filename", help="the beatmap (.ka/.osu) to play")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild compiled beatmap cache")
+    parser.add_argument("--profile", action="store_true", help="report latency of data nodes")
+    parser.add_argument("--record", metavar="DIR", help="record this session into given directory, replacing the session recorded there")
+    parser.add_argument("--replay", metavar="DIR", help="replay recorded session without audio devices")
+    parser.add_argument("--simulate", action="store_true", help="autoplay headlessly by virtual clock, and report scores")
+    args = parser.parse_args()
 
-        console = KnockConsole()
-        console.play(beatmap)
+    beatmap = load_beatmap(args.filename, rebuild=args.rebuild)
 
+    if args.replay is not None:
+        recorded = KnockSession(args.replay)
+        console = KnockConsole(recorded.config_filename)
+        replayed = console.replay(beatmap, args.replay)
+
+        mismatched = 0
+        for kind in ("knock", "judge"):
+            expected, actual = recorded.get(kind), replayed.get(kind)
+            for i in range(max(len(expected), len(actual))):
+                if expected[i:i+1] != actual[i:i+1]:
+                    mismatched += 1
+                    print("{}: {!r} != {!r}".format(kind, expected[i:i+1], actual[i:i+1]))
+            print("{}: {} recorded, {} replayed".format(kind, len(expected), len(actual)))
+        print("mismatched: {}".format(mismatched))
+        raise SystemExit(1 if mismatched else 0)
+
+    console = KnockConsole()
+    if args.profile:
+        console.config.set("debug", "profile", "yes")
+
+    if args.simulate:
+        report = console.simulate(beatmap, knocks=beatmap.autoplay())
+        print("score: {}/{}  progress: {:.1f}%".format(report["score"], report["total_score"], report["progress"]))
+        for perf, count in report["perfs"].items():
+            print("  {}: {}".format(perf, count))
+        print("simulated {:.1f} s in {:.3f} s ({:.1f}x realtime)".format(
+              report["duration"], report["wall_time"], report["speed"]))
+        for name, timing in report["timings"].items():
+            print("  {}: {} calls, mean {:.3f} ms".format(name, timing["calls"], timing["mean_ms"]))
+        if console.profiler is not None:
+            print()
+            print(console.profiler.report())
+        raise SystemExit
+
+    console.play(beatmap, args.record)
+
+    print()
+    for event in beatmap.events:
+        print(event)
+
+    if console.profiler is not None:
         print()
-        for event in beatmap.events:
-            print(event)
+        print(console.profiler.report())
@@ -1,7 +1,11 @@
+import os
 import enum
+import math
+import functools
 import wave
 import re
-import curses
+import hashlib
+import pickle
 import numpy
 import realtime_analysis as ra
 import audioread
@@ -22,16 +26,87 @@ HIT_DECAY = 0.4
 HIT_SUSTAIN = 0.1
 PREPARE_TIME = 1.0
 SKIP_TIME = 8.0
+PREFETCH_DEPTH = 16
+BEATS_FREQ = 1000.0
+BEATS_DECAY_TIME = 0.01
+
+CACHE_DIR = "__kcache__"
+CACHE_VERSION = 3
+
+
+# sounds
+@functools.lru_cache(maxsize=None)
+def get_beat_sound(kind, samplerate, amplitude, *params):
+    """Get shared read-only sound of beat.
+
+    Parameters
+    ----------
+    kind : str
+        The kind of sound, `"pulse"` or `"pulses"`.
+    samplerate : int
+        The sample rate.
+    amplitude : float
+        The amplitude of pulse.
+    params : tuple
+        The additional parameters; `(step, number)` for `"pulses"`.
+
+    Returns
+    -------
+    sound : ndarray
+        The read-only sound.
+    """
+    if kind == "pulse":
+        sound = ra.pulse(samplerate=samplerate, freq=BEATS_FREQ, decay_time=BEATS_DECAY_TIME, amplitude=amplitude)
+    elif kind == "pulses":
+        step, number = params
+        pulse = get_beat_sound("pulse", samplerate, amplitude)
+        sound = ra.scatter(pulse, [step*i for i in range(number)], samplerate=samplerate)
+    else:
+        raise ValueError("invalid kind: {!r}".format(kind))
+
+    sound.flags.writeable = False
+    return sound
 
 
 # scripts
+class Column:
+    """A field of event, which is stored in a column of `EventTable`.
+
+    Views of events copy constant fields (declared by `fields`) from columns
+    on creation, and read and write states (declared by `states`) through
+    columns by this descriptor.
+
+    Parameters
+    ----------
+    name : str
+        The name of column.
+    decode : function, optional
+        The function to convert stored item to value of field.
+    """
+    def __init__(self, name, decode=None):
+        self.name = name
+        self.decode = decode
+
+    def __get__(self, view, owner=None):
+        if view is None:
+            return self
+        item = getattr(view.table, self.name).item(view.index)
+        return self.decode(item) if self.decode is not None else item
+
+    def __set__(self, view, value):
+        getattr(view.table, self.name)[view.index] = value
+
 class Event:
-    pass
+    __slots__ = ()
+    fields = dict()
+    states = dict()
     # time, lifespan, zindex
     # def sound(self, samplerate): pass
     # def draw(self, track, time): pass
 
 class Sym(Event):
+    __slots__ = ("time", "symbol", "speed")
+    fields = dict(time=Column("time"), symbol=Column("extra"), speed=Column("speed"))
     zindex = -2
 
     def __init__(self, time, symbol=" ", speed=1.0):
@@ -64,7 +139,9 @@ class Beat(Event):
     # def draw(self, track, time): pass
     # def draw_judging(self, track, time): pass
     # def draw_hitting(self, track, time): pass
+    # def autoplay(self): pass
 
+    __slots__ = ()
     tolerances = TOLERANCES
 
     @property
@@ -81,6 +158,9 @@ class Beat(Event):
     def draw_hitting(self, track, time): pass
 
 class SingleBeat(Beat):
+    __slots__ = ("time", "speed", "perf")
+    fields = dict(time=Column("time"), speed=Column("speed"))
+    states = dict(perf=Column("perf"))
     total_score = 10
     perf_syms = PERF_SYMS
     wrong_symbol = WRONG_SYM
@@ -126,25 +206,33 @@ class SingleBeat(Beat):
         self.perf.draw(track, self.speed < 0, self.perf_syms)
 
 class Soft(SingleBeat):
+    __slots__ = ()
     symbol = BEATS_SYMS[0]
 
     def hit(self, time, strength):
         super().hit(time, strength, strength < 0.5)
 
     def sound(self, samplerate):
-        return ra.pulse(samplerate=samplerate, freq=1000.0, decay_time=0.01, amplitude=0.5)
+        return get_beat_sound("pulse", samplerate, 0.5)
+
+    def autoplay(self):
+        return [(self.time, 0.25)]
 
     def __repr__(self):
         return "Soft(time={!r}, speed={!r}, perf={!r})".format(self.time, self.speed, self.perf)
 
 class Loud(SingleBeat):
+    __slots__ = ()
     symbol = BEATS_SYMS[1]
 
     def hit(self, time, strength):
         super().hit(time, strength, strength >= 0.5)
 
     def sound(self, samplerate):
-        return ra.pulse(samplerate=samplerate, freq=1000.0, decay_time=0.01, amplitude=1.0)
+        return get_beat_sound("pulse", samplerate, 1.0)
+
+    def autoplay(self):
+        return [(self.time, 1.0)]
 
     def __repr__(self):
         return "Loud(time={!r}, speed={!r}, perf={!r})".format(self.time, self.speed, self.perf)
@@ -165,6 +253,8 @@ class IncrGroup:
         return "IncrGroup(threshold={!r}, total={!r})".format(self.threshold, self.total)
 
 class Incr(SingleBeat):
+    __slots__ = ("count", "group")
+    fields = dict(SingleBeat.fields, count=Column("param", int), group=Column("extra"))
     symbol = BEATS_SYMS[2]
     incr_tol = INCR_TOL
 
@@ -181,13 +271,19 @@ class Incr(SingleBeat):
 
     def sound(self, samplerate):
         amplitude = 0.5 + 0.5 * (self.count-1)/self.group.total
-        return ra.pulse(samplerate=samplerate, freq=1000.0, decay_time=0.01, amplitude=amplitude)
+        return get_beat_sound("pulse", samplerate, amplitude)
+
+    def autoplay(self):
+        return [(self.time, 0.5 + 0.5 * (self.count-1)/self.group.total)]
 
     def __repr__(self):
         return "Incr(time={!r}, speed={!r}, perf={!r}, count={!r}, group={!r})".format(
                      self.time, self.speed, self.perf, self.count, self.group)
 
 class Roll(Beat):
+    __slots__ = ("time", "end", "speed", "number", "roll", "finished")
+    fields = dict(time=Column("time"), end=Column("end"), speed=Column("speed"), number=Column("param", int))
+    states = dict(roll=Column("state", int), finished=Column("finished"))
     symbol = BEATS_SYMS[3]
 
     def __init__(self, time, end, number, speed=1.0, roll=0, finished=False):
@@ -222,14 +318,12 @@ class Roll(Beat):
         self.finished = True
 
     def sound(self, samplerate):
-        sound = ra.pulse(samplerate=samplerate, freq=1000.0, decay_time=0.01, amplitude=1.0)
         step = (self.end - self.time)/(self.number-1) if self.number > 1 else 0.0
-        rolls_sounds = [(step*i, sound) for i in range(self.number)]
-        duration = self.end - self.time + 0.01
+        return get_beat_sound("pulses", samplerate, 1.0, step, self.number)
 
-        gen = ra.pipe(ra.empty(samplerate=samplerate, duration=duration),
-                      ra.attach(rolls_sounds, samplerate=samplerate))
-        return ra.collect(gen)
+    def autoplay(self):
+        step = (self.end - self.time)/(self.number-1) if self.number > 1 else 0.0
+        return [(self.time + step * r, 1.0) for r in range(self.number)]
 
     def draw(self, track, time):
         step = (self.end - self.time)/(self.number-1) if self.number > 1 else 0.0
@@ -244,6 +338,9 @@ class Roll(Beat):
                      self.time, self.end, self.number, self.speed, self.roll, self.finished)
 
 class Spin(Beat):
+    __slots__ = ("time", "end", "speed", "capacity", "charge", "finished")
+    fields = dict(time=Column("time"), end=Column("end"), speed=Column("speed"), capacity=Column("param"))
+    states = dict(charge=Column("state"), finished=Column("finished"))
     total_score = 10
     symbols = BEATS_SYMS[4]
     finished_sym = SPIN_FINISHED_SYM
@@ -273,14 +370,13 @@ class Spin(Beat):
         self.finished = True
 
     def sound(self, samplerate):
-        sound = ra.pulse(samplerate=samplerate, freq=1000.0, decay_time=0.01, amplitude=0.5)
         step = (self.end - self.time)/self.capacity if self.capacity > 0.0 else 0.0
-        spin_sounds = [(step*i, sound) for i in range(int(self.capacity))]
-        duration = self.end - self.time
+        return get_beat_sound("pulses", samplerate, 0.5, step, int(self.capacity))
 
-        gen = ra.pipe(ra.empty(samplerate=samplerate, duration=duration),
-                      ra.attach(spin_sounds, samplerate=samplerate))
-        return ra.collect(gen)
+    def autoplay(self):
+        number = math.ceil(self.capacity/2.0)
+        step = (self.end - self.time)/number if number > 0 else 0.0
+        return [(self.time + step * r, 1.0) for r in range(number)]
 
     def draw(self, track, time):
         if self.charge < self.capacity:
@@ -385,14 +481,259 @@ class Performance(enum.Enum):
             track.addstr(0.0, perf_syms[5])
 
 
+# event table
+class EventView:
+    """A view of event in `EventTable`, whose states are read from and written to columns."""
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, table, index):
+        view = object.__new__(cls)
+        view.table = table
+        view.index = index
+        for name, column in cls.fields.items():
+            item = getattr(table, column.name).item(index)
+            setattr(view, name, column.decode(item) if column.decode is not None else item)
+        return view
+
+    @property
+    def lifespan(self):
+        return (self.table.lifespan_start.item(self.index), self.table.lifespan_end.item(self.index))
+
+class BeatView(EventView):
+    __slots__ = ()
+
+    @property
+    def range(self):
+        return (self.table.range_start.item(self.index), self.table.range_end.item(self.index))
+
+@functools.lru_cache(maxsize=None)
+def get_view_class(cls):
+    """Get the class of views of given event class.
+
+    The view class is a subclass of the event class, whose states declared by
+    `states` are replaced by columns, so all methods of events work on views.
+    """
+    base = BeatView if issubclass(cls, Beat) else EventView
+    namespace = dict(cls.states, __slots__=("table", "index"),
+                     __module__=cls.__module__, __qualname__=cls.__qualname__)
+    return type(cls.__name__, (base, cls), namespace)
+
+class EventTable:
+    """Events stored as columns, which are accessed by lightweight views.
+
+    Each event is a row of the table, whose fields and states are stored in
+    the columns declared by `fields` and `states` of its class; lifespans and
+    ranges are computed once on construction. Indexing and iterating give
+    views of events, which write states to the columns, so judgements are
+    kept in the table. Selections made by `take`, `beats` and `query` share
+    the columns.
+
+    Parameters
+    ----------
+    events : list of Event
+        The events to store.
+    """
+    columns = dict(time=numpy.float64, end=numpy.float64, speed=numpy.float64,
+                   state=numpy.float64, param=numpy.float64, finished=numpy.bool_,
+                   perf=object, extra=object)
+    fanout = 64
+
+    def __init__(self, events):
+        events = list(events)
+        length = len(events)
+
+        # fill columns as lists, and convert each of them at once
+        self.kinds = []
+        kinds = dict()
+        kind = [0] * length
+        values = {name: [None if dtype is object else 0] * length for name, dtype in self.columns.items()}
+        lifespans = [None] * length
+        ranges = [(numpy.nan, numpy.nan)] * length
+
+        for index, event in enumerate(events):
+            cls = type(event)
+            if cls not in kinds:
+                kinds[cls] = len(self.kinds)
+                self.kinds.append(cls)
+            kind[index] = kinds[cls]
+
+            for name, column in [*cls.fields.items(), *cls.states.items()]:
+                values[column.name][index] = getattr(event, name)
+            lifespans[index] = event.lifespan
+            if isinstance(event, Beat):
+                ranges[index] = event.range
+
+        self.kind = numpy.array(kind, dtype=numpy.uint8)
+        for name, dtype in self.columns.items():
+            if dtype is object:
+                setattr(self, name, numpy.fromiter(values[name], dtype=object, count=length))
+            else:
+                setattr(self, name, numpy.array(values[name], dtype=dtype))
+        self.lifespan_start, self.lifespan_end = numpy.array(lifespans, dtype=numpy.float64).reshape(length, 2).T.copy()
+        self.range_start, self.range_end = numpy.array(ranges, dtype=numpy.float64).reshape(length, 2).T.copy()
+
+        self.order = numpy.arange(length)
+
+        # z-indices of kinds, which are decided by states for beats
+        self.kind_is_beat = numpy.array([issubclass(cls, Beat) for cls in self.kinds], dtype=bool)
+        self.kind_zindex = numpy.array([1 if issubclass(cls, Beat) else cls.zindex for cls in self.kinds], dtype=int)
+
+        # index of lifespans: rows sorted by start, and a tree of maximum end
+        # over blocks of them, from blocks of `fanout` rows up to the root
+        self.by_start = numpy.argsort(self.lifespan_start, kind="stable")
+        self.end_tree = []
+        level = self.lifespan_end[self.by_start]
+        while len(level) > self.fanout:
+            padding = numpy.full(-len(level) % self.fanout, -numpy.inf)
+            level = numpy.concatenate([level, padding]).reshape(-1, self.fanout).max(axis=1)
+            self.end_tree.append(level)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        views = [get_view_class(cls) for cls in self.kinds]
+        for index, kind in zip(self.order.tolist(), self.kind[self.order].tolist()):
+            yield views[kind].create(self, index)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.take(key)
+        return self.view(int(self.order[key]))
+
+    def view(self, index):
+        """Get the view of event at given row of columns."""
+        return get_view_class(self.kinds[self.kind[index]]).create(self, index)
+
+    def views(self, cache):
+        """Get views of selected events, which reuse views in given cache.
+
+        Parameters
+        ----------
+        cache : dict
+            The views of rows, which is updated to hold only views of selected events.
+
+        Returns
+        -------
+        views : list
+            The views of selected events.
+        """
+        rows = self.order.tolist()
+        views = [cache[row] if row in cache else self.view(row) for row in rows]
+        cache.clear()
+        cache.update(zip(rows, views))
+        return views
+
+    def get(self, name):
+        """Get values of given column, in the order of selected events."""
+        return getattr(self, name)[self.order]
+
+    def select(self, rows):
+        """Select events by rows of columns."""
+        table = object.__new__(EventTable)
+        table.__dict__.update(self.__dict__)
+        table.order = rows
+        return table
+
+    def take(self, indices):
+        """Select events by indices of this table."""
+        return self.select(self.order[indices])
+
+    def beats(self):
+        """Select beats, ordered by start of their ranges."""
+        rows = self.order[self.kind_is_beat[self.kind[self.order]]]
+        return self.select(rows[numpy.argsort(self.range_start[rows], kind="stable")])
+
+    def query(self, start, stop=None):
+        """Select events whose lifespans overlap with given range, ordered by start of lifespans.
+
+        Like `realtime_analysis.IntervalIndex`, it finds events with lifespan
+        `(s, e)` such that `s < stop and e >= start`, among all events of the
+        table.  The tree of maximum end is searched from the root, and only
+        blocks containing found events (and at most one more block per level)
+        are visited, so long events don't slow down the search.
+
+        Parameters
+        ----------
+        start : float
+            The start of range.
+        stop : float, optional
+            The stop of range, default is equal to `start`.
+
+        Returns
+        -------
+        events : EventTable
+            The found events.
+        """
+        stop = start if stop is None else stop
+        count = numpy.searchsorted(self.lifespan_start, stop, "left", sorter=self.by_start).item()
+
+        # search blocks of rows in `by_start` which may contain found events,
+        # and drop the children of the last block beyond the first `count` rows
+        size = self.fanout ** len(self.end_tree)
+        blocks = numpy.arange(-(-count // size))
+        for level in reversed(self.end_tree):
+            blocks = blocks[level[blocks] >= start]
+            if len(blocks) == 0:
+                break
+            size //= self.fanout
+            blocks = (blocks[:, None] * self.fanout + numpy.arange(self.fanout)).ravel()
+            blocks = blocks[:len(blocks) - max(0, blocks[-1].item() + 1 - -(-count // size))]
+
+        rows = self.by_start[blocks]
+        return self.select(rows[self.lifespan_end[rows] >= start])
+
+    @ra.DataNode.from_generator
+    def get_dripper(self):
+        """A data node to find events whose lifespans overlap with received time.
+
+        Like `realtime_analysis.drip`, it receives time and yields the events
+        found by `query`.  The events are searched again only if time moves
+        backward or any lifespan starts or ends, otherwise the same selection
+        is yielded.
+        """
+        events = None
+        start = stop = numpy.nan
+
+        time = yield
+        while True:
+            if not start <= time <= stop:
+                events = self.query(time)
+
+                # the found events are unchanged until next lifespan starts or any of them ends
+                count = numpy.searchsorted(self.lifespan_start, time, "left", sorter=self.by_start).item()
+                next_start = self.lifespan_start[self.by_start[count]].item() if count < len(self.by_start) else numpy.inf
+                start, stop = time, min(next_start, self.lifespan_end[events.order].min(initial=numpy.inf).item())
+
+            time = yield events
+
+    def zindex(self):
+        """Get z-indices of selected events, which are the same as `zindex` of events."""
+        # only beats have states, and finished beats are moved to the bottom
+        zindex = self.kind_zindex[self.kind[self.order]]
+        zindex[self.finished[self.order] | numpy.not_equal(self.perf[self.order], None)] = -1
+        return zindex
+
+    def key(self):
+        """Get hash of contents of selected events, including their states."""
+        hasher = hashlib.sha1(repr([cls.__name__ for cls in self.kinds]).encode("utf8"))
+        for name in ["kind", *self.columns]:
+            column = self.get(name)
+            hasher.update(repr(column.tolist()).encode("utf8") if column.dtype == object else column.tobytes())
+        return hasher.hexdigest()
+
+
 # beatmap
 class Hitter:
     hit_decay = HIT_DECAY
     hit_sustain = HIT_SUSTAIN
     target_syms = TARGET_SYMS
+    check_score = False
 
     def __init__(self, beats):
-        self.beats = sorted(beats, key=lambda e: e.range[0])
+        # beats are ordered by start of their ranges
+        self.beats = beats
 
         self.hit_index = 0
         self.hit_time = -100.0
@@ -401,19 +742,36 @@ class Hitter:
         self.draw_index = 0
         self.current_beat = None
 
-    @property
-    def total_score(self):
-        return sum(beat.total_score for beat in self.beats)
-
-    @property
-    def score(self):
-        return sum(beat.score for beat in self.beats)
+        # score state, which is updated whenever a beat is hit or finished
+        self.score, self.total_score, self.finished_count = self.recount()
 
     @property
     def progress(self):
         if len(self.beats) == 0:
             return 1000
-        return sum(1 for beat in self.beats if beat.finished) * 1000 // len(self.beats)
+        return self.finished_count * 1000 // len(self.beats)
+
+    def recount(self):
+        """Count score, total score and number of finished beats over all beats."""
+        score = total_score = finished = 0
+        for beat in self.beats:
+            score += beat.score
+            total_score += beat.total_score
+            finished += beat.finished
+        return score, total_score, finished
+
+    def judge(self, beat, action, *args):
+        """Perform action on given beat (hit or finish), and update score state."""
+        score, finished = beat.score, beat.finished
+        action(*args)
+        self.score += beat.score - score
+        self.finished_count += beat.finished - finished
+
+        if self.check_score:
+            expected = self.recount()
+            if (self.score, self.total_score, self.finished_count) != expected:
+                raise RuntimeError("inconsistent score state: {!r} != {!r}".format(
+                                   (self.score, self.total_score, self.finished_count), expected))
 
     @ra.DataNode.from_generator
     def get_beats_handler(self):
@@ -423,7 +781,7 @@ class Hitter:
         while True:
             while beat is not None and (beat.finished or beat.range[1] < time):
                 if not beat.finished:
-                    beat.finish()
+                    self.judge(beat, beat.finish)
                 beat = next(beats, None)
 
             time = yield (beat if beat is not None and beat.range[0] < time else None)
@@ -445,7 +803,7 @@ class Hitter:
                 if self.current_beat is None:
                     continue
 
-                self.current_beat.hit(time, strength)
+                self.judge(self.current_beat, self.current_beat.hit, time, strength)
                 self.current_beat = beats_handler.send(time)
 
     def update_draw_index(self, time):
@@ -462,46 +820,120 @@ class Hitter:
             loudness = max(1, loudness)
         track.addstr(0.0, self.target_syms[loudness])
 
-class Track:
-    def __init__(self, win, offset, padding=5):
-        self.win = win
-        self.offset = offset
+class Canvas:
+    """A one-line character buffer, which writes only changed cells to window.
 
+    Characters are drawn as curses does: each character takes one cell, and
+    backspace moves back one cell.
+    """
+    def __init__(self, win, y=0):
+        self.win = win
+        self.y = y
         _, width = self.win.getmaxyx()
         self.width = width
+        self.cells = [" "]*width
+        self.shown = None
+
+    def clear(self):
+        self.cells[:] = [" "]*self.width
+
+    def addstr(self, index, msg):
+        draw(self.cells, index, msg)
+
+    def refresh(self):
+        """Write changed cells to window, and skip refreshing if nothing changed.
+
+        Returns
+        -------
+        changed : bool
+            Whether the window is updated.
+        """
+        if self.shown is None:
+            self.win.addstr(self.y, 0, "".join(self.cells[:self.width-1]))
+            self.win.refresh()
+            self.shown = list(self.cells)
+            return True
+
+        changed = False
+        index = 0
+        while index < self.width-1:
+            if self.cells[index] == self.shown[index]:
+                index += 1
+                continue
+
+            # write a run of changed cells at once
+            start = index
+            while index < self.width-1 and self.cells[index] != self.shown[index]:
+                index += 1
+            self.win.addstr(self.y, start, "".join(self.cells[start:index]))
+            self.shown[start:index] = self.cells[start:index]
+            changed = True
+
+        if changed:
+            self.win.refresh()
+        return changed
+
+class Track:
+    def __init__(self, canvas, x, width, offset, padding=5):
+        self.canvas = canvas
+        self.x = x
+        self.width = width
+        self.offset = offset
         self.padding = padding
-        self.pad = curses.newpad(1, self.width+self.padding*2)
+        self.cells = [" "]*(self.width+self.padding*2)
 
     def clear(self):
-        self.pad.clear()
+        self.cells[:] = [" "]*len(self.cells)
 
     def refresh(self):
-        self.pad.overwrite(self.win, 0, self.padding, 0, 0, 0, self.width-1)
+        self.canvas.cells[self.x:self.x+self.width] = self.cells[self.padding:self.padding+self.width]
 
     def addstr(self, pos, msg):
         index = round((pos + self.offset) * self.width)
         if index in range(self.width):
-            self.pad.addstr(0, index + self.padding, msg)
+            draw(self.cells, index + self.padding, msg)
+
+def draw(cells, index, msg):
+    for ch in msg:
+        if ch == "\b":
+            index -= 1
+            continue
+        if 0 <= index < len(cells):
+            cells[index] = ch
+        index += 1
 
 class Beatmap:
     prepare_time = PREPARE_TIME
+    skip_time = SKIP_TIME
     spec_width = SPEC_WIDTH
+    prefetch_depth = PREFETCH_DEPTH
 
-    def __init__(self, audio, events):
+    def __init__(self, audio, events, duration=None):
         self.audio = audio
-        if self.audio is not None:
+        if duration is not None:
+            self.duration = duration
+        elif self.audio is not None:
             with audioread.audio_open(self.audio) as file:
                 self.duration = file.duration
         else:
             self.duration = 0.0
 
-        self.events = list(events)
-        self.start = min(0.0, min(event.lifespan[0] - self.prepare_time for event in self.events))
-        self.end = max(self.duration, max(event.lifespan[1] + self.prepare_time for event in self.events))
+        self.events = events if isinstance(events, EventTable) else EventTable(events)
+        self.start = min(0.0, self.events.lifespan_start.min(initial=numpy.inf).item() - self.prepare_time)
+        self.end = max(self.duration, self.events.lifespan_end.max(initial=-numpy.inf).item() + self.prepare_time)
 
-        self.hitter = Hitter(event for event in self.events if isinstance(event, Beat))
+        self.hitter = Hitter(self.events.beats())
 
         self.spectrum = " "*self.spec_width
+        self.underruns = 0
+        self.seek_request = None
+        self.time_offsets = [(0.0, 0.0)]
+
+        if self.audio is not None:
+            self.cache_dir = os.path.join(os.path.dirname(self.audio), CACHE_DIR)
+        else:
+            self.cache_dir = CACHE_DIR
+        self.events_key = self.events.key()
 
     def __enter__(self):
         return self
@@ -509,9 +941,44 @@ class Beatmap:
     def __exit__(self, type, value, traceback):
         pass
 
-    def set_audio_params(self, samplerate, hop_length):
+    def set_audio_params(self, samplerate, hop_length, channels=1):
+        """Set params of the output stream, which the sound handler renders.
+
+        The audio, beats track and spectrum are rendered in this sample rate,
+        and times of stream given to `get_time` are in seconds, so the input
+        stream may have another sample rate.
+
+        Parameters
+        ----------
+        samplerate : int
+            The sample rate of output stream.
+        hop_length : int
+            The buffer length of output stream.
+        channels : int, optional
+            The number of channels of output stream, default is `1`.
+        """
         self.samplerate = samplerate
         self.hop_length = hop_length
+        self.channels = channels
+
+    def autoplay(self):
+        """Generate knocks of perfect play, composed by tuples of time and strength."""
+        return sorted(knock for beat in self.hitter.beats for knock in beat.autoplay())
+
+    def seek(self, time):
+        """Jump to given time of beatmap.
+
+        The request is performed by the sound handler at its next buffer, and
+        beats before the new time are finished as missed.
+        """
+        self.seek_request = min(max(time, self.start), self.end)
+
+    def get_time(self, stream_time):
+        """Convert time of stream into time of beatmap, with seeking considered."""
+        for time, offset in reversed(self.time_offsets):
+            if stream_time >= time:
+                return self.start + stream_time + offset
+        return self.start + stream_time
 
     @ra.DataNode.from_generator
     def get_knock_handler(self):
@@ -519,7 +986,7 @@ class Beatmap:
         with knock_handler:
             time, strength, detected = yield
             while True:
-                time, strength, detected = yield knock_handler.send((time+self.start, strength, detected))
+                time, strength, detected = yield knock_handler.send((self.get_time(time), strength, detected))
 
     def get_spectrum_handler(self):
         WIN_LENGTH = 512*4
@@ -532,31 +999,114 @@ class Beatmap:
                        lambda s: setattr(self, "spectrum", s))
         return spec
 
+    @ra.DataNode.from_generator
     def get_sound_handler(self):
         # generate sound
         if self.audio is None:
-            sound = ra.DataNode.wrap([])
+            sound = ra.empty(self.hop_length, self.samplerate)
         elif isinstance(self.audio, str):
-            sound = ra.load(self.audio, buffer_length=self.hop_length, samplerate=self.samplerate)
+            # load from `start` to `end`, padded by silence
+            sound = ra.load(self.audio, buffer_length=self.hop_length, samplerate=self.samplerate,
+                                        start=self.start, end=self.end, cache=self.cache_dir,
+                                        channels=self.channels)
+
+            # decode in background
+            def underrun():
+                self.underruns += 1
+            sound = ra.prefetch(sound, self.prefetch_depth, underrun)
         else:
             raise ValueError
 
-        if self.start < 0:
-            sound = ra.chain(ra.empty(self.hop_length, self.samplerate, -self.start), sound)
-        if self.end > self.duration:
-            sound = ra.chain(sound, ra.empty(self.hop_length, self.samplerate, self.end - self.duration))
+        spectrum = self.get_spectrum_handler()
+        beats_track = self.get_beats_track()
+        mono = numpy.zeros(self.hop_length, dtype=numpy.float32)
+
+        # skip long intro
+        first = min(self.events.lifespan_start.min(initial=numpy.inf).item(), self.end) - self.prepare_time
+        if self.skip_time is not None and first - self.start > self.skip_time:
+            self.seek(first)
+
+        self.time_offsets = [(0.0, 0.0)]
+        start_index = round(self.start * self.samplerate)
+        length = round(self.end * self.samplerate) - start_index
+
+        with sound, spectrum:
+            yield
+            stream_index = 0
+            index = 0
+            while index < length:
+                # seek sound and beats track
+                if self.seek_request is not None:
+                    index = round((self.seek_request - self.start) * self.samplerate)
+                    self.seek_request = None
+                    data = sound.send((start_index + index) / self.samplerate)
+                    self.time_offsets.append((stream_index / self.samplerate, (index - stream_index) / self.samplerate))
+                else:
+                    data = sound.send()
+
+                if not data.flags.writeable:
+                    data = numpy.copy(data)
+
+                # add spec
+                spectrum.send(ra.remix(data, 1, out=mono))
+
+                # add beats sounds
+                stop = min(index + len(data), len(beats_track))
+                if index < stop:
+                    beats = beats_track[index:stop]
+                    data[:stop-index] += beats[:, None] if data.ndim > 1 else beats
+
+                index += len(data)
+                stream_index += len(data)
+                yield data
+
+    def get_beats_track_filename(self):
+        """Get the filename of beats track cache, which is keyed by events,
+        sample rate and beats sound parameters."""
+        key = "{}:{}:{!r}:{!r}:{}".format(self.events_key, self.samplerate,
+                                          BEATS_FREQ, BEATS_DECAY_TIME, CACHE_VERSION)
+        key = hashlib.sha1(key.encode("utf8")).hexdigest()
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def get_beats_track(self):
+        """Render sounds of all events into one track.
+
+        The track starts at `self.start`, and is cached by events, sample rate
+        and beats sound parameters.
+
+        Returns
+        -------
+        track : ndarray
+            The rendered track with dtype float32.
+        """
+        cache_filename = self.get_beats_track_filename()
+
+        if not os.path.exists(cache_filename):
+            # group events by shared sounds, and scatter each sound at once
+            sounds = dict()
+            times = dict()
+            for event in self.events:
+                sound = event.sound(self.samplerate)
+                if len(sound) == 0:
+                    continue
+                sounds[id(sound)] = sound
+                times.setdefault(id(sound), []).append(event.time - self.start)
 
-        # add spec
-        sound = ra.pipe(sound, ra.branch(self.get_spectrum_handler()))
+            length = max([int(max(times[key]) * self.samplerate) + len(sound)
+                          for key, sound in sounds.items()], default=0)
+            track = numpy.zeros(length, dtype=numpy.float32)
+            for key, sound in sounds.items():
+                ra.scatter(sound, times[key], samplerate=self.samplerate, out=track)
 
-        # add beats sounds
-        beats_sounds = [(event.time - self.start, event.sound(self.samplerate)) for event in self.events]
-        sound = ra.pipe(sound, ra.attach(beats_sounds, buffer_length=self.hop_length, samplerate=self.samplerate))
+            with ra.atomic_open(cache_filename) as file:
+                numpy.save(file, track)
+            return track
 
-        return sound
+        # loaded into memory, since it is sliced in the audio callback
+        return numpy.load(cache_filename)
 
     @ra.DataNode.from_generator
-    def get_screen_handler(self, scr):
+    def get_screen_handler(self, scr, ticker=None):
         _, width = scr.getmaxyx()
 
         spec_offset = 1
@@ -566,23 +1116,34 @@ class Beatmap:
         track_width = width - 24 - self.spec_width
 
         bar_offset = 0.1
-        track = Track(scr.subwin(1, track_width, 0, track_offset), bar_offset)
+        canvas = Canvas(scr)
+        track = Track(canvas, track_offset, track_width, bar_offset)
+        stats_canvas = Canvas(scr, 1) if ticker is not None else None
+
+        # views of visible events, which are reused between frames
+        visible = dict()
+        found = None
+        finished_count = None
+        events = []
 
-        dripper = ra.drip(self.events, lambda e: e.lifespan)
+        dripper = self.events.get_dripper()
 
         with dripper:
             while True:
                 time = yield
-                time += self.start
+                time = self.get_time(time)
                 self.hitter.update_draw_index(time)
-                scr.clear()
+                canvas.clear()
                 track.clear()
 
                 # draw events
-                ## find visible events, and move finished events to the bottom
-                events = dripper.send(time)
-                events = sorted(events, key=lambda e: -e.zindex)
-                for event in events[::-1]:
+                ## find visible events, and move finished events to the bottom; they
+                ## are sorted again only if visible events change or any beat is finished
+                selected = dripper.send(time)
+                if selected is not found or self.hitter.finished_count != finished_count:
+                    found, finished_count = selected, self.hitter.finished_count
+                    events = found.take(numpy.argsort(-found.zindex(), kind="stable")[::-1]).views(visible)
+                for event in events:
                     event.draw(track, time)
 
                 # draw target
@@ -597,11 +1158,18 @@ class Beatmap:
 
                 # draw others
                 track.refresh()
-                scr.addstr(0, spec_offset, self.spectrum)
-                scr.addstr(0, score_offset, "[{:>5d}/{:>5d}]".format(self.hitter.score, self.hitter.total_score))
-                scr.addstr(0, progress_offset, "[{:>5.1f}%]".format(self.hitter.progress/10))
+                canvas.addstr(spec_offset, self.spectrum)
+                canvas.addstr(score_offset, "[{:>5d}/{:>5d}]".format(self.hitter.score, self.hitter.total_score))
+                canvas.addstr(progress_offset, "[{:>5.1f}%]".format(self.hitter.progress/10))
 
-                scr.refresh()
+                canvas.refresh()
+
+                # draw display statistics
+                if stats_canvas is not None:
+                    stats_canvas.clear()
+                    stats_canvas.addstr(spec_offset, "{:>5.1f} fps  jitter {:>5.2f} ms  dropped {:d}".format(
+                                                     ticker.fps, ticker.jitter*1000, ticker.dropped))
+                    stats_canvas.refresh()
 
 
 class BeatmapStdSheet:
@@ -660,3 +1228,227 @@ class BeatmapStdSheet:
         self.events += self.pattern(*value)(0)
         return self
 
+
+
+def read_sheet(filename):
+    """Read beatmap sheet from .ka file.
+
+    The audio file is resolved relative to the directory of the .ka file.
+
+    Parameters
+    ----------
+    filename : str
+        The .ka file to read.
+
+    Returns
+    -------
+    sheet : BeatmapStdSheet
+        The sheet with expanded events.
+    """
+    with open(filename) as file:
+        sheet = BeatmapStdSheet()
+        exec(file.read(), dict(), dict(sheet=sheet))
+    if sheet.audio is not None:
+        sheet.audio = os.path.join(os.path.dirname(filename), sheet.audio)
+    return sheet
+
+def read_osu(filename):
+    """Read beatmap sheet from .osu file.
+
+    The file is parsed line by line in one pass.  Hit circles are mapped to
+    `Soft` (don) or `Loud` (kat, which has whistle or clap), sliders to
+    `Roll`, and spinners to `Spin`, with ticks at the slider tick rate.  The
+    speed of events follows slider velocity.
+
+    Parameters
+    ----------
+    filename : str
+        The .osu file to read.
+
+    Returns
+    -------
+    sheet : BeatmapStdSheet
+        The sheet with expanded events.
+    """
+    WHISTLE = 2
+    CLAP = 8
+    CIRCLE = 1
+    SLIDER = 2
+    SPINNER = 8
+
+    sheet = BeatmapStdSheet()
+    sections = dict(General={}, Metadata={}, Difficulty={})
+    timings = [] # timing points: (time, beat length, is uninherited)
+    index = 0 # index of next timing point
+    beat_length = 500.0
+    velocity = 1.0
+
+    with open(filename, encoding="utf-8-sig") as file:
+        section = None
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith("//"):
+                continue
+
+            if line.startswith("[") and line.endswith("]"):
+                section = line[1:-1]
+                if section == "HitObjects":
+                    slider_multiplier = float(sections["Difficulty"].get("SliderMultiplier", 1.4))
+                    tick_rate = float(sections["Difficulty"].get("SliderTickRate", 1.0))
+
+            elif section in sections:
+                key, _, value = line.partition(":")
+                sections[section][key.strip()] = value.strip()
+
+            elif section == "TimingPoints":
+                values = line.split(",")
+                uninherited = values[6] != "0" if len(values) > 6 else True
+                timings.append((float(values[0]), float(values[1]), uninherited))
+
+            elif section == "HitObjects":
+                values = line.split(",")
+                time, type, hit_sound = int(values[2]), int(values[3]), int(values[4])
+
+                # apply timing points up to this object
+                while index < len(timings) and timings[index][0] <= time:
+                    _, length, uninherited = timings[index]
+                    if uninherited:
+                        beat_length, velocity = length, 1.0
+                    elif length < 0:
+                        velocity = -100.0 / length
+                    index += 1
+
+                step = beat_length / tick_rate / 1000.0
+
+                if type & CIRCLE:
+                    if hit_sound & (WHISTLE | CLAP):
+                        sheet.events.append(Loud(time/1000.0, speed=velocity))
+                    else:
+                        sheet.events.append(Soft(time/1000.0, speed=velocity))
+
+                elif type & SLIDER:
+                    slides, length = int(values[6]), float(values[7])
+                    duration = length / (slider_multiplier * 100.0 * velocity) * beat_length * slides / 1000.0
+                    number = round(duration/step)+1
+                    sheet.events.append(Roll(time/1000.0, time/1000.0+duration, number=number, speed=velocity))
+
+                elif type & SPINNER:
+                    end = int(values[5])
+                    capacity = (end - time) / 1000.0 / step
+                    sheet.events.append(Spin(time/1000.0, end/1000.0, capacity=capacity, speed=velocity))
+
+    general = sections["General"]
+    metadata = sections["Metadata"]
+    sheet.metadata = "".join("\n{}: {}".format(key.lower(), metadata[key])
+                             for key in ("Title", "Artist", "Creator", "Version", "Source") if key in metadata) + "\n"
+    if "AudioFilename" in general:
+        sheet.audio = os.path.join(os.path.dirname(filename), general["AudioFilename"])
+
+    return sheet
+
+@functools.lru_cache(maxsize=None)
+def get_audio_duration(filename, mtime):
+    """Get duration of audio file, which is shared by beatmaps of the same audio."""
+    with audioread.audio_open(filename) as file:
+        return file.duration
+
+def compile_beatmap(filename, cache_filename):
+    """Compile .ka or .osu file into binary format.
+
+    The compiled file is a pickle of event table and metadata, which is
+    tagged by `CACHE_VERSION` and mtime of the audio file.
+
+    Parameters
+    ----------
+    filename : str
+        The .ka or .osu file to compile.
+    cache_filename : str
+        The compiled file to write.
+
+    Returns
+    -------
+    data : dict
+        The compiled data.
+    """
+    if os.path.splitext(filename)[1] == ".osu":
+        sheet = read_osu(filename)
+    else:
+        sheet = read_sheet(filename)
+
+    if sheet.audio is not None:
+        audio_mtime = os.path.getmtime(sheet.audio)
+        duration = get_audio_duration(sheet.audio, audio_mtime)
+    else:
+        duration = 0.0
+        audio_mtime = None
+
+    data = dict(version=CACHE_VERSION,
+                metadata=sheet.metadata,
+                audio=sheet.audio,
+                audio_mtime=audio_mtime,
+                duration=duration,
+                events=EventTable(sheet.events))
+
+    with ra.atomic_open(cache_filename) as file:
+        pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return data
+
+def get_cache_filename(filename, cache_dir=CACHE_DIR):
+    """Get compiled filename of .ka or .osu file, which is keyed by its content hash."""
+    with open(filename, "rb") as file:
+        key = hashlib.sha1(file.read()).hexdigest()
+    return os.path.join(os.path.dirname(filename), cache_dir, key + ".kac")
+
+def read_compiled(cache_filename):
+    """Read compiled file, which is `None` if it is missing or out of date.
+
+    Parameters
+    ----------
+    cache_filename : str
+        The compiled file to read.
+
+    Returns
+    -------
+    data : dict or None
+        The compiled data.
+    """
+    if not os.path.exists(cache_filename):
+        return None
+
+    try:
+        with open(cache_filename, "rb") as file:
+            data = pickle.load(file)
+    except Exception:
+        return None
+
+    if data.get("version") != CACHE_VERSION:
+        return None
+    if data["audio"] is not None and (not os.path.exists(data["audio"])
+                                      or os.path.getmtime(data["audio"]) != data["audio_mtime"]):
+        return None
+
+    return data
+
+def load_beatmap(filename, rebuild=False):
+    """Load beatmap from .ka or .osu file via compiled cache.
+
+    Parameters
+    ----------
+    filename : str
+        The .ka or .osu file to load.
+    rebuild : bool, optional
+        Rebuild compiled cache even if it is up to date.
+
+    Returns
+    -------
+    beatmap : Beatmap
+        The loaded beatmap.
+    """
+    cache_filename = get_cache_filename(filename)
+
+    data = read_compiled(cache_filename) if not rebuild else None
+    if data is None:
+        data = compile_beatmap(filename, cache_filename)
+
+    return Beatmap(data["audio"], data["events"], duration=data["duration"])
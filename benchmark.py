@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import time
+import json
+import argparse
+import subprocess
+import numpy
+import knock
+import beatmap as bm
+
+
+def load(filename, no_audio=False):
+    if no_audio:
+        sheet = bm.read_sheet(filename)
+        return bm.Beatmap(None, sheet.events)
+    return bm.load_beatmap(filename)
+
+def synthesize_knocks(beatmap, samplerate, length, seed=0):
+    """Generate noise with decaying noise bursts at each beat."""
+    rng = numpy.random.default_rng(seed)
+    signal = rng.normal(0.0, 1e-3, length).astype(numpy.float32)
+    burst = rng.normal(0.0, 1.0, int(0.02*samplerate)).astype(numpy.float32)
+    burst *= numpy.exp(-numpy.arange(len(burst))/(0.003*samplerate)).astype(numpy.float32)
+
+    for beat in beatmap.hitter.beats:
+        amplitude = 0.8 if isinstance(beat, bm.Loud) else 0.3
+        start = int((beat.time - beatmap.start) * samplerate)
+        end = min(start + len(burst), length)
+        if 0 <= start < length:
+            signal[start:end] += amplitude * burst[:end-start]
+    return signal
+
+def measure(node, args, budget):
+    """Send each item of `args` to node, and collect timing statistics."""
+    latencies = numpy.zeros(len(args))
+    with node:
+        for i, arg in enumerate(args):
+            start = time.perf_counter()
+            node.send(arg)
+            latencies[i] = time.perf_counter() - start
+
+    total = latencies.sum()
+    return dict(calls=len(args),
+                rate=len(args)/total if total > 0 else float("inf"),
+                mean_ms=latencies.mean()*1000,
+                p99_ms=numpy.percentile(latencies, 99)*1000,
+                max_ms=latencies.max()*1000,
+                budget_ms=budget*1000,
+                headroom=budget/latencies.mean())
+
+def bench_input(filename, console, no_audio=False):
+    beatmap = load(filename, no_audio)
+    samplerate = int(console.config["input"]["samplerate"])
+    hop_length = int(console.config["input"]["buffer"])
+    beatmap.set_audio_params(samplerate, hop_length)
+
+    count = int((beatmap.end - beatmap.start) * samplerate / hop_length)
+    signal = synthesize_knocks(beatmap, samplerate, count*hop_length)
+    return measure(console.get_input_node(beatmap), list(signal.reshape(count, hop_length)), hop_length/samplerate)
+
+def bench_output(filename, console, no_audio=False):
+    beatmap = load(filename, no_audio)
+    samplerate = int(console.config["output"]["samplerate"])
+    hop_length = int(console.config["output"]["buffer"])
+    beatmap.set_audio_params(samplerate, hop_length)
+    beatmap.skip_time = None
+
+    # warm up caches of decoded audio and beats track
+    beatmap.get_beats_track()
+
+    # stop before the last buffer, where the sound handler is finalized
+    count = int((beatmap.end - beatmap.start) * samplerate / hop_length) - 1
+    return measure(console.get_output_node(beatmap), [None]*count, hop_length/samplerate)
+
+def bench_screen(filename, console, no_audio=False, width=80):
+    beatmap = load(filename, no_audio)
+    samplerate = int(console.config["input"]["samplerate"])
+    hop_length = int(console.config["input"]["buffer"])
+    beatmap.set_audio_params(samplerate, hop_length)
+    display_fps = int(console.config["controls"]["display_fps"])
+
+    scr = knock.VirtualWindow(1, width)
+    count = int((beatmap.end - beatmap.start) * display_fps)
+    times = [i/display_fps for i in range(count)]
+    result = measure(beatmap.get_screen_handler(scr), times, 1/display_fps)
+
+    result["writes_per_frame"] = scr.writes / count
+    result["refreshes_per_frame"] = scr.refreshes / count
+    return result
+
+def get_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+BENCHMARKS = dict(input=bench_input, output=bench_output, screen=bench_screen)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="headless benchmarks of K-AIKO input, output and render paths")
+    parser.add_argument("filename", nargs="?", default="蛋餅好朋友 [normal].ka", help="the beatmap (.ka) to benchmark")
+    parser.add_argument("--only", choices=sorted(BENCHMARKS), action="append", help="run only given benchmarks")
+    parser.add_argument("--no-audio", action="store_true", help="replace music by silence, no decoder needed")
+    parser.add_argument("--config", help="the config file of knock console")
+    parser.add_argument("--json", help="write results to given file")
+    args = parser.parse_args()
+
+    console = knock.KnockConsole(args.config)
+
+    results = dict(revision=get_revision(), filename=args.filename)
+    for name in args.only or sorted(BENCHMARKS):
+        result = BENCHMARKS[name](args.filename, console, no_audio=args.no_audio)
+        results[name] = result
+
+        print("{:<7s} {:>8d} calls {:>10.1f} /s   mean {:>7.3f} ms   p99 {:>7.3f} ms   max {:>7.3f} ms   "
+              "budget {:>7.3f} ms   headroom {:>6.1f}x".format(
+              name, result["calls"], result["rate"], result["mean_ms"], result["p99_ms"], result["max_ms"],
+              result["budget_ms"], result["headroom"]))
+        if "writes_per_frame" in result:
+            print("{:<7s} {:>8.1f} writes/frame {:>6.1f} refreshes/frame".format(
+                  "", result["writes_per_frame"], result["refreshes_per_frame"]))
+
+    if args.json is not None:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import json
+import hashlib
+import argparse
+import functools
+import collections
+import concurrent.futures
+import numpy
+import knock
+import beatmap as bm
+import realtime_analysis as ra
+
+
+MANIFEST = "manifest.json"
+
+
+def find_sheets(directory):
+    """Find all .ka and .osu files under given directory, except cache directories."""
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if d != bm.CACHE_DIR)
+        for name in sorted(files):
+            if name.endswith((".ka", ".osu")):
+                yield os.path.join(root, name)
+
+def get_key(filename):
+    with open(filename, "rb") as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+def validate(beatmap):
+    """Check the beatmap, and return the list of warnings."""
+    warnings = []
+    beats = beatmap.hitter.beats
+
+    if len(beats) == 0:
+        warnings.append("no beats")
+
+    if beatmap.audio is not None:
+        outside = numpy.count_nonzero((beats.get("range_start") < 0.0) | (beats.get("range_end") > beatmap.duration))
+        if outside > 0:
+            warnings.append("{} beats outside the audio".format(outside))
+
+    # beats closer than the great tolerance can't be told apart by the player
+    overlapped = numpy.count_nonzero(numpy.diff(beats.get("time")) < bm.TOLERANCES[0])
+    if overlapped > 0:
+        warnings.append("{} overlapped beats".format(overlapped))
+
+    return warnings
+
+def build(filename, samplerate, hop_length, channels, beats_track=False, force=False):
+    """Compile and validate a .ka or .osu file, and build cache of beats track.
+
+    The audio file is resolved relative to the directory of the beatmap file,
+    and returned in the statistics, so that audio shared by beatmaps can be
+    decoded once by `build_audio`.  The beats track is rendered only if
+    `beats_track` is set, otherwise it is rendered on the first play; its
+    cache file is also returned in the statistics.
+    """
+    start_time = time.perf_counter()
+
+    cache_filename = bm.get_cache_filename(filename)
+    data = bm.read_compiled(cache_filename) if not force else None
+    if data is None:
+        data = bm.compile_beatmap(filename, cache_filename)
+
+    beatmap = bm.Beatmap(data["audio"], data["events"], duration=data["duration"])
+    beatmap.set_audio_params(samplerate, hop_length, channels)
+    beats_track_filename = None
+    if beats_track:
+        beatmap.get_beats_track()
+        beats_track_filename = beatmap.get_beats_track_filename()
+
+    counts = numpy.bincount(beatmap.events.kind, minlength=len(beatmap.events.kinds))
+    kinds = collections.Counter()
+    for cls, count in zip(beatmap.events.kinds, counts.tolist()):
+        kinds[cls.__name__] += count
+    return dict(events=len(beatmap.events),
+                beats=len(beatmap.hitter.beats),
+                kinds=dict(kinds),
+                total_score=beatmap.hitter.total_score,
+                duration=beatmap.duration,
+                audio=beatmap.audio,
+                beats_track=beats_track_filename,
+                warnings=validate(beatmap),
+                elapsed=time.perf_counter() - start_time)
+
+def build_audio(audio, samplerate, channels):
+    """Build cache of decoded audio, which is shared by beatmaps in the same directory."""
+    ra.load_cache(audio, samplerate, os.path.join(os.path.dirname(audio), bm.CACHE_DIR), channels)
+
+def try_call(func, *args, **kwargs):
+    """Call given function, and return its result and error message."""
+    try:
+        return func(*args, **kwargs), None
+    except Exception as exc:
+        return None, "{}: {}".format(type(exc).__name__, exc)
+
+def load_manifest(filename):
+    try:
+        with open(filename, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return dict()
+
+def save_manifest(filename, manifest):
+    with ra.atomic_open(filename, "w") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+
+def is_unchanged(filename, entry, options):
+    """Check if the beatmap file is unchanged since last successful build.
+
+    The file is unchanged if its mtime, or else its content hash, is the same
+    as recorded, it was built with the same audio params, and its compiled
+    file and the caches required by `options` are still up to date.
+    """
+    if entry is None or entry.get("error") is not None:
+        return False
+
+    built = entry.get("options")
+    if built is None or any(built[name] != options[name] for name in ("samplerate", "hop_length", "channels")):
+        return False
+    if options["audio"] and not built["audio"] or options["beats_track"] and not built["beats_track"]:
+        return False
+
+    mtime = os.path.getmtime(filename)
+    if mtime != entry["mtime"]:
+        if get_key(filename) != entry["key"]:
+            return False
+        entry["mtime"] = mtime
+
+    cache_filename = os.path.join(os.path.dirname(filename), bm.CACHE_DIR, entry["key"] + ".kac")
+    if bm.read_compiled(cache_filename) is None:
+        return False
+
+    # caches of audio are removed with the cache directory or keyed by mtime of audio
+    stats = entry["stats"]
+    if options["audio"] and stats["audio"] is not None:
+        try:
+            cache_dir = os.path.join(os.path.dirname(stats["audio"]), bm.CACHE_DIR)
+            audio_filename = ra.get_cache_filename(stats["audio"], options["samplerate"], cache_dir, options["channels"])
+        except OSError:
+            return False
+        if not os.path.exists(audio_filename):
+            return False
+    if options["beats_track"] and not os.path.exists(stats["beats_track"]):
+        return False
+
+    return True
+
+def report(path, entry, skipped):
+    if entry.get("error") is not None:
+        print("FAIL  {}: {}".format(path, entry["error"]))
+        return
+
+    stats = entry["stats"]
+    print("{:<4s}  {:>7.2f} s  {:>5d} events  {:>5d} beats  {:>6d} pts  {:>7.1f} s audio  {}".format(
+          "skip" if skipped else "ok", stats["elapsed"], stats["events"], stats["beats"],
+          stats["total_score"], stats["duration"], path))
+    for warning in stats["warnings"]:
+        print("      warning: {}".format(warning))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compile and validate all K-AIKO beatmaps (.ka/.osu) in a directory")
+    parser.add_argument("directory", help="the directory of beatmaps")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="the number of worker processes")
+    parser.add_argument("--force", action="store_true", help="rebuild all beatmaps even if they are unchanged")
+    parser.add_argument("--no-audio", action="store_true", help="don't build decoded audio caches")
+    parser.add_argument("--beats-track", action="store_true", help="also render beats tracks, which are large")
+    parser.add_argument("--config", help="the config file of knock console, which decides audio params")
+    args = parser.parse_args()
+
+    config = knock.KnockConsole(args.config).config
+    samplerate = int(config["output"]["samplerate"])
+    hop_length = int(config["output"]["buffer"])
+    channels = int(config["output"]["channels"])
+    options = dict(samplerate=samplerate, hop_length=hop_length, channels=channels,
+                   audio=not args.no_audio, beats_track=args.beats_track)
+
+    directory = os.path.abspath(args.directory)
+    manifest_filename = os.path.join(directory, bm.CACHE_DIR, MANIFEST)
+    manifest = load_manifest(manifest_filename)
+
+    start_time = time.perf_counter()
+    pending = []
+    skipped = []
+    found = set()
+    for filename in find_sheets(directory):
+        path = os.path.relpath(filename, directory)
+        found.add(path)
+        if not args.force and is_unchanged(filename, manifest.get(path), options):
+            skipped.append(path)
+            continue
+
+        manifest[path] = dict(mtime=os.path.getmtime(filename), key=get_key(filename), options=options)
+        pending.append((path, filename))
+
+    for path in skipped:
+        report(path, manifest[path], True)
+
+    # beatmaps are sent to workers in chunks, since most of them compile in milliseconds
+    jobs = args.jobs or os.cpu_count() or 1
+    chunksize = max(1, len(pending) // (jobs * 4))
+    task = functools.partial(try_call, build, samplerate=samplerate, hop_length=hop_length, channels=channels,
+                             beats_track=args.beats_track, force=args.force)
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+        results = executor.map(task, [filename for _, filename in pending], chunksize=chunksize)
+        for (path, _), (stats, error) in zip(pending, results):
+            manifest[path]["stats"] = stats
+            manifest[path]["error"] = error
+
+        # decode each audio once, since difficulties of a song share the same audio
+        audios = collections.defaultdict(list)
+        for path, _ in pending:
+            stats = manifest[path]["stats"]
+            if not args.no_audio and stats is not None and stats["audio"] is not None:
+                audios[stats["audio"]].append(path)
+
+        task = functools.partial(try_call, build_audio, samplerate=samplerate, channels=channels)
+        results = executor.map(task, list(audios))
+        for (audio, paths), (_, error) in zip(audios.items(), results):
+            if error is not None:
+                for path in paths:
+                    manifest[path]["error"] = "audio {}: {}".format(os.path.relpath(audio, directory), error)
+
+    for path, _ in pending:
+        report(path, manifest[path], False)
+
+    # forget removed beatmaps
+    manifest = {path: entry for path, entry in manifest.items() if path in found}
+    save_manifest(manifest_filename, manifest)
+
+    failed = sum(1 for path, _ in pending if manifest[path]["error"] is not None)
+    print()
+    print("{} built, {} skipped, {} failed in {:.2f} s".format(
+          len(pending) - failed, len(skipped), failed, time.perf_counter() - start_time))
+    raise SystemExit(1 if failed else 0)
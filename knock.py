@@ -1,4 +1,9 @@
+import os
+import ast
 import time
+import queue
+import threading
+import collections
 import itertools
 import contextlib
 import configparser
@@ -9,6 +14,129 @@ import pyaudio
 import realtime_analysis as ra
 
 
+CHANNEL_DECAY_TIME = 1.0
+
+
+class VirtualWindow:
+    """A curses window without terminal, which counts writes to screen."""
+    def __init__(self, height=2, width=80):
+        self.height = height
+        self.width = width
+        self.lines = [[" "]*width for _ in range(height)]
+        self.writes = 0
+        self.refreshes = 0
+
+    def getmaxyx(self):
+        return (self.height, self.width)
+
+    def clear(self):
+        self.lines = [[" "]*self.width for _ in range(self.height)]
+
+    def addstr(self, y, x, msg):
+        self.writes += 1
+        line = self.lines[y]
+        for ch in msg:
+            if ch == "\b":
+                x -= 1
+                continue
+            if x in range(self.width):
+                line[x] = ch
+            x += 1
+
+    def refresh(self):
+        self.refreshes += 1
+
+
+class KnockSession:
+    """A session of knock console, recorded in a directory.
+
+    The directory contains the config of console (`console.kconfig`), the raw
+    input signal in float32 (`input.f4`) and the log of session
+    (`session.log`).  Each line of the log is a tab-separated record of kind
+    `knock` (time and strength of judged knock), `drain` (the hop index
+    detector is drained), `offset` (the time offset of seeking) or `judge`
+    (the final state of beat).
+
+    Parameters
+    ----------
+    path : str, optional
+        The directory of session, default is a session without files.
+    new : bool, optional
+        Whether to start a new session in the directory, which replaces the
+        recorded one instead of loading its log; default is `False`.
+    """
+    def __init__(self, path=None, new=False):
+        self.path = path
+        self.records = []
+
+        if self.path is not None and not new and os.path.exists(self.log_filename):
+            with open(self.log_filename, "r") as file:
+                for line in file:
+                    kind, *values = line.rstrip("\n").split("\t")
+                    self.records.append((kind, *map(ast.literal_eval, values)))
+
+    @property
+    def config_filename(self):
+        return os.path.join(self.path, "console.kconfig")
+
+    @property
+    def signal_filename(self):
+        return os.path.join(self.path, "input.f4")
+
+    @property
+    def log_filename(self):
+        return os.path.join(self.path, "session.log")
+
+    def log(self, kind, *values):
+        self.records.append((kind, *values))
+
+    def get(self, kind):
+        return [record[1:] for record in self.records if record[0] == kind]
+
+    def save(self):
+        with open(self.log_filename, "w") as file:
+            for kind, *values in self.records:
+                file.write("\t".join([kind, *map(repr, values)]) + "\n")
+
+    def read_signal(self, channels=1):
+        signal = numpy.fromfile(self.signal_filename, dtype=numpy.float32)
+        return signal.reshape(-1, channels) if channels > 1 else signal
+
+    @ra.DataNode.from_generator
+    def get_recorder(self):
+        # the file is written by a background thread, so that writing never
+        # blocks the input stream callback
+        buffers = queue.Queue()
+        finished = object()
+        errors = []
+
+        def write():
+            try:
+                with open(self.signal_filename, "wb") as file:
+                    while True:
+                        data = buffers.get()
+                        if data is finished:
+                            break
+                        file.write(data.tobytes())
+            except BaseException as exc:
+                errors.append(exc)
+                # keep consuming, so that the recorder never piles up buffers
+                while buffers.get() is not finished:
+                    pass
+
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+
+        try:
+            while True:
+                buffers.put(numpy.array((yield), dtype=numpy.float32))
+        finally:
+            buffers.put(finished)
+            writer.join()
+            if errors:
+                raise errors[0]
+
+
 class KnockConsole:
     def __init__(self, config_filename=None):
         config = configparser.ConfigParser()
@@ -26,10 +154,52 @@ class KnockConsole:
 
         self.config = config
         self.closed = False
+        self.paused = False
+        self.draining = False
+        self.profiler = None
+        self.ticker = None
+        self.clock = None
+        self.input_stream = None
+        self.output_stream = None
+        self.session = None
 
     def close(self):
         self.closed = True
 
+    def pause(self):
+        if self.paused:
+            return
+        self.paused = True
+
+        idle_fps = int(self.config["controls"]["idle_fps"])
+
+        # stop streams, so that all clocks stop with the output stream
+        if self.output_stream is not None:
+            self.output_stream.stop_stream()
+        if self.input_stream is not None:
+            self.input_stream.stop_stream()
+        if self.clock is not None:
+            self.clock.pause()
+        if self.ticker is not None:
+            self.ticker.reset(1/idle_fps)
+
+    def resume(self):
+        if not self.paused:
+            return
+        self.paused = False
+
+        display_fps = int(self.config["controls"]["display_fps"])
+
+        # ignore knocks detected from signal before pausing
+        self.draining = True
+
+        if self.ticker is not None:
+            self.ticker.reset(1/display_fps)
+        if self.input_stream is not None:
+            self.input_stream.start_stream()
+        if self.output_stream is not None:
+            self.output_stream.start_stream()
+
     def SIGINT_handler(self, sig, frame):
         self.close()
 
@@ -42,7 +212,10 @@ class KnockConsole:
         with contextlib.closing(self), sound_handler:
             yield
             while True:
-                data = sound_handler.send()
+                try:
+                    data = sound_handler.send()
+                except StopIteration:
+                    return
                 data *= music_volume
                 yield data
 
@@ -50,6 +223,7 @@ class KnockConsole:
     def get_input_node(self, knock_game):
         samplerate = int(self.config["input"]["samplerate"])
         hop_length = int(self.config["input"]["buffer"])
+        channels = int(self.config["input"]["channels"])
         Dt = hop_length / samplerate
 
         win_length = int(self.config["detector"]["win_length"])
@@ -59,6 +233,7 @@ class KnockConsole:
         post_avg = float(self.config["detector"]["post_avg"])
         wait = float(self.config["detector"]["wait"])
         delta = float(self.config["detector"]["delta"])
+        channel_weights = self.config["detector"]["channel_weights"]
 
         pre_max = round(pre_max / Dt)
         post_max = round(post_max / Dt)
@@ -72,9 +247,46 @@ class KnockConsole:
 
         knock_handler = knock_game.get_knock_handler()
 
+        # after resuming, the detector is drained until the signal before pausing
+        # leaves the window and the peak picker
+        drain_length = -(-win_length // hop_length) + delay
+        drain_count = 0
+        def gate(a):
+            nonlocal drain_count
+            if drain_count > 0:
+                drain_count -= 1
+                return (a[0], a[1], False)
+            if a[2] and self.session is not None:
+                self.session.log("knock", float(a[0]), float(a[1]))
+            return a
+
+        # mix multi-channel signal down by given weights, or by power of each
+        # channel (which favors the closest mic)
+        mono = numpy.zeros(hop_length, dtype=numpy.float32)
+        if channel_weights == "auto":
+            weights = numpy.full(channels, 1/channels, dtype=numpy.float32)
+            energy = numpy.zeros(channels, dtype=numpy.float32)
+            power = numpy.zeros(channels, dtype=numpy.float32)
+            smoothing = min(1.0, Dt / CHANNEL_DECAY_TIME)
+        else:
+            weights = numpy.array(channel_weights.split(), dtype=numpy.float32)
+        def mix(data):
+            if data.ndim == 1:
+                return data
+            if channel_weights == "auto":
+                numpy.einsum("ij,ij->j", data, data, out=power)
+                numpy.subtract(power, energy, out=power)
+                numpy.multiply(power, smoothing, out=power)
+                numpy.add(energy, power, out=energy)
+                total = energy.sum()
+                if total > 0.0:
+                    numpy.divide(energy, total, out=weights)
+            return ra.remix(data, 1, weights, out=mono)
+
         # use halfhann window
-        window = numpy.sin(numpy.linspace(0, numpy.pi/2, win_length))**2
-        detector = ra.pipe(ra.frame(win_length, hop_length),
+        window = ra.get_half_Hann_window(win_length)
+        detector = ra.pipe(mix,
+                           ra.frame(win_length, hop_length),
                            ra.power_spectrum(win_length, samplerate=samplerate, windowing=window, weighting=True),
                            ra.onset_strength(samplerate/win_length),
                            (lambda a: (None, a, a)),
@@ -85,18 +297,37 @@ class KnockConsole:
                            (lambda a: (a[0]*hop_length/samplerate-knock_delay,
                                        a[1]*knock_volume,
                                        a[2])),
+                           gate,
                            knock_handler)
 
-        with contextlib.closing(self), detector:
+        if self.session is not None and self.session.path is not None:
+            recorder = self.session.get_recorder()
+        else:
+            recorder = None
+
+        with contextlib.closing(self), detector, recorder or contextlib.suppress():
+            index = 0
             while True:
-                detector.send((yield))
+                data = yield
+                if recorder is not None:
+                    recorder.send(data)
+
+                if self.draining:
+                    self.draining = False
+                    drain_count = drain_length
+                    if self.session is not None:
+                        self.session.log("drain", index)
+
+                detector.send(data)
+                index += 1
 
     @ra.DataNode.from_generator
     def get_screen_node(self, knock_game):
         display_delay = float(self.config["controls"]["display_delay"])
+        show_fps = self.config.getboolean("debug", "show_fps")
 
         stdscr = curses.initscr()
-        knock_handler = knock_game.get_screen_handler(stdscr)
+        knock_handler = knock_game.get_screen_handler(stdscr, self.ticker if show_fps else None)
 
         try:
             curses.noecho()
@@ -106,43 +337,253 @@ class KnockConsole:
             curses.curs_set(0)
 
             with contextlib.closing(self), knock_handler:
-                reference_time = time.time()
-
                 while True:
                     yield
                     signal.signal(signal.SIGINT, self.SIGINT_handler)
-                    t = time.time() - reference_time - display_delay
+
+                    if stdscr.getch() == ord(" "):
+                        if self.paused:
+                            self.resume()
+                        else:
+                            self.pause()
+
+                    t = self.clock.time() - display_delay
                     knock_handler.send(t)
 
         finally:
             curses.endwin()
 
-    def play(self, knock_game):
+    def play(self, knock_game, session=None):
+        """Play the game with audio devices.
+
+        Parameters
+        ----------
+        knock_game : Beatmap
+            The game to play.
+        session : str, optional
+            The directory to record this session, default is no recording.
+        """
         input_samplerate = int(self.config["input"]["samplerate"])
         input_buffer_length = int(self.config["input"]["buffer"])
         input_format = self.config["input"]["format"]
+        input_channels = int(self.config["input"]["channels"])
         output_samplerate = int(self.config["output"]["samplerate"])
         output_buffer_length = int(self.config["output"]["buffer"])
         output_format = self.config["output"]["format"]
+        output_channels = int(self.config["output"]["channels"])
         display_fps = int(self.config["controls"]["display_fps"])
 
+        self.ticker = ra.Ticker(1/display_fps)
+        self.clock = ra.StreamClock(output_samplerate)
+
+        if self.config.getboolean("debug", "profile"):
+            budget = min(input_buffer_length/input_samplerate, output_buffer_length/output_samplerate)
+            self.profiler = ra.Profiler(budget)
+        else:
+            self.profiler = None
+
+        if session is not None:
+            os.makedirs(session, exist_ok=True)
+            self.session = KnockSession(session, new=True)
+            with open(self.session.config_filename, "w") as file:
+                self.config.write(file)
+        else:
+            self.session = None
+
         try:
             manager = pyaudio.PyAudio()
 
-            with contextlib.closing(self), knock_game:
-                knock_game.set_audio_params(input_samplerate, input_buffer_length)
+            with contextlib.closing(self), knock_game, self.profiler or contextlib.suppress():
+                knock_game.set_audio_params(output_samplerate, output_buffer_length, output_channels)
 
                 output_node = self.get_output_node(knock_game)
                 input_node = self.get_input_node(knock_game)
                 screen_node = self.get_screen_node(knock_game)
 
-                with ra.record(manager, input_node, input_buffer_length, input_samplerate, input_format) as input_stream,\
-                     ra.play(manager, output_node, output_buffer_length, output_samplerate, output_format) as output_stream:
+                with ra.record(manager, input_node, input_buffer_length, input_samplerate, input_format,
+                               channels=input_channels) as input_stream,\
+                     ra.play(manager, output_node, output_buffer_length, output_samplerate, output_format,
+                             channels=output_channels, clock=self.clock) as output_stream:
 
+                    self.input_stream = input_stream
+                    self.output_stream = output_stream
+                    self.paused = False
+
+                    self.clock.latency = output_stream.get_output_latency()
                     input_stream.start_stream()
                     output_stream.start_stream()
-                    ra.loop(screen_node, 1/display_fps, lambda: self.closed)
+                    try:
+                        ra.loop(screen_node, 1/display_fps, lambda: self.closed, self.ticker)
+                    finally:
+                        self.input_stream = None
+                        self.output_stream = None
 
         finally:
             manager.terminate()
 
+        if self.session is not None:
+            self.log_result(knock_game)
+            self.session.save()
+
+    def replay(self, knock_game, session):
+        """Replay recorded session without audio devices, faster than realtime.
+
+        The recorded input signal is fed through the input node, with the
+        same drains and time offsets as recorded.  It should be played with
+        the config of recorded session.
+
+        Parameters
+        ----------
+        knock_game : Beatmap
+            The game to replay, which should be a fresh one of the recorded game.
+        session : str
+            The directory of recorded session.
+
+        Returns
+        -------
+        replayed : KnockSession
+            The replayed session without files, whose records can be compared
+            with the recorded ones.
+        """
+        samplerate = int(self.config["input"]["samplerate"])
+        hop_length = int(self.config["input"]["buffer"])
+        channels = int(self.config["input"]["channels"])
+        output_samplerate = int(self.config["output"]["samplerate"])
+        output_buffer_length = int(self.config["output"]["buffer"])
+        output_channels = int(self.config["output"]["channels"])
+
+        recorded = KnockSession(session)
+        signal = recorded.read_signal(channels)
+        drains = {index for index, in recorded.get("drain")}
+
+        self.session = KnockSession()
+        knock_game.set_audio_params(output_samplerate, output_buffer_length, output_channels)
+        knock_game.time_offsets = [(0.0, 0.0)] + recorded.get("offset")
+
+        with knock_game:
+            input_node = self.get_input_node(knock_game)
+            with input_node:
+                for index in range(len(signal) // hop_length):
+                    if index in drains:
+                        self.draining = True
+                    input_node.send(signal[index*hop_length:(index+1)*hop_length])
+
+        self.log_result(knock_game)
+        replayed, self.session = self.session, None
+        return replayed
+
+    def simulate(self, knock_game, signal=None, knocks=None, window=None):
+        """Play the game headlessly by virtual clock, as fast as possible.
+
+        The output, input and screen nodes are driven in the order of their
+        periods on the virtual clock, without audio devices and terminal.
+
+        Parameters
+        ----------
+        knock_game : Beatmap
+            The game to play.
+        signal : ndarray, optional
+            The input signal fed to the detector, default is silence.
+        knocks : list, optional
+            The scripted knocks in time of beatmap, composed by tuples of time
+            and strength, which bypass the detector, such as
+            `knock_game.autoplay()`.
+        window : VirtualWindow, optional
+            The window to draw, default is a new one.
+
+        Returns
+        -------
+        report : dict
+            The final score and the timings of each node.
+        """
+        input_samplerate = int(self.config["input"]["samplerate"])
+        input_buffer_length = int(self.config["input"]["buffer"])
+        input_channels = int(self.config["input"]["channels"])
+        output_samplerate = int(self.config["output"]["samplerate"])
+        output_buffer_length = int(self.config["output"]["buffer"])
+        output_channels = int(self.config["output"]["channels"])
+        display_fps = int(self.config["controls"]["display_fps"])
+        display_delay = float(self.config["controls"]["display_delay"])
+        show_fps = self.config.getboolean("debug", "show_fps")
+
+        if self.config.getboolean("debug", "profile"):
+            budget = min(input_buffer_length/input_samplerate, output_buffer_length/output_samplerate)
+            self.profiler = ra.Profiler(budget)
+        else:
+            self.profiler = None
+
+        if window is None:
+            window = VirtualWindow()
+        self.ticker = ra.Ticker(1/display_fps)
+
+        @ra.DataNode.from_generator
+        def get_knock_node():
+            script = iter(sorted(knocks))
+            knock = next(script, None)
+            with knock_game.hitter.get_knock_handler() as knock_handler:
+                while True:
+                    now = knock_game.get_time((yield) * input_buffer_length / input_samplerate)
+                    while knock is not None and knock[0] <= now:
+                        knock_handler.send((knock[0], knock[1], True))
+                        knock = next(script, None)
+                    knock_handler.send((now, 0.0, False))
+
+        @ra.DataNode.from_generator
+        def get_signal_node():
+            shape = (input_buffer_length, input_channels) if input_channels > 1 else input_buffer_length
+            silence = numpy.zeros(shape, dtype=numpy.float32)
+            with self.get_input_node(knock_game) as input_node:
+                while True:
+                    index = yield
+                    if signal is not None and (index+1)*input_buffer_length <= len(signal):
+                        input_node.send(signal[index*input_buffer_length:(index+1)*input_buffer_length])
+                    else:
+                        input_node.send(silence)
+
+        with knock_game, self.profiler or contextlib.suppress():
+            knock_game.set_audio_params(output_samplerate, output_buffer_length, output_channels)
+
+            output_node = self.get_output_node(knock_game)
+            input_node = get_knock_node() if knocks is not None else get_signal_node()
+            screen_node = knock_game.get_screen_handler(window, self.ticker if show_fps else None)
+
+            # each node is called when the virtual clock reaches its next period
+            periods = [output_buffer_length/output_samplerate, input_buffer_length/input_samplerate, 1/display_fps]
+            counts = [0, 0, 0]
+            timings = [0.0, 0.0, 0.0]
+
+            with output_node, input_node, screen_node:
+                start_time = time.perf_counter()
+                while True:
+                    n = min(range(3), key=lambda n: counts[n] * periods[n])
+                    now = counts[n] * periods[n]
+                    try:
+                        tick = time.perf_counter()
+                        if n == 0:
+                            output_node.send()
+                        elif n == 1:
+                            input_node.send(counts[n])
+                        else:
+                            screen_node.send(now - display_delay)
+                        timings[n] += time.perf_counter() - tick
+                    except StopIteration:
+                        break
+                    counts[n] += 1
+                wall_time = time.perf_counter() - start_time
+
+        perfs = collections.Counter(str(beat.perf) for beat in knock_game.hitter.beats if hasattr(beat, "perf"))
+        return dict(score=knock_game.hitter.score,
+                    total_score=knock_game.hitter.total_score,
+                    progress=knock_game.hitter.progress/10,
+                    perfs=dict(perfs),
+                    duration=now,
+                    wall_time=wall_time,
+                    speed=now/wall_time if wall_time > 0 else float("inf"),
+                    timings={name: dict(calls=count, mean_ms=timing/count*1000 if count else 0.0)
+                             for name, count, timing in zip(("output", "input", "screen"), counts, timings)})
+
+    def log_result(self, knock_game):
+        for time, offset in knock_game.time_offsets[1:]:
+            self.session.log("offset", float(time), float(offset))
+        for index, beat in enumerate(knock_game.hitter.beats):
+            self.session.log("judge", index, repr(beat))
@@ -1,9 +1,16 @@
+import os
 import time
+import math
+import hashlib
+import queue
+import threading
+import tempfile
 import functools
 import itertools
 import contextlib
 import numpy
 import scipy
+import scipy.fft
 import scipy.fftpack
 import scipy.signal
 import pyaudio
@@ -67,7 +74,10 @@ class DataNode:
     def from_generator(gen):
         @functools.wraps(gen)
         def node_builder(*args, **kwargs):
-            return DataNode(gen(*args, **kwargs))
+            node = DataNode(gen(*args, **kwargs))
+            if Profiler.current is not None:
+                Profiler.current.instrument(node, gen.__qualname__)
+            return node
         return node_builder
 
     @staticmethod
@@ -93,6 +103,232 @@ class DataNode:
                     data = yield node_like(data)
             return pure_func()
 
+class Profiler:
+    """Latency statistics of data nodes.
+
+    Data nodes built in the context of profiler are instrumented, which
+    records number of calls and histogram of latency of each node; nodes
+    built outside are untouched, so there is no overhead without profiling.
+    The latency of combinators (`pipe`, `pair`, `branch`, ...) includes
+    their children.
+
+    Parameters
+    ----------
+    budget : float, optional
+        The time budget of each call, e.g. `buffer_length / samplerate`.
+    """
+    current = None
+
+    # log-spaced latency bins from 100ns to 10s, 20 bins per decade
+    edges = 10.0 ** numpy.arange(-7.0, 1.0+1e-9, 0.05)
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.stats = dict()
+        self.counts = dict()
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = Profiler.current
+        Profiler.current = self
+        return self
+
+    def __exit__(self, type, value, traceback):
+        Profiler.current = self.previous
+        self.previous = None
+
+    def instrument(self, node, name):
+        """Replace `send` of given node by timed one."""
+        count = self.counts[name] = self.counts.get(name, 0) + 1
+        name = name if count == 1 else "{}#{}".format(name, count)
+        stat = self.stats[name] = dict(calls=0, over=0, max=0.0,
+                                       hist=numpy.zeros(len(self.edges)+1, dtype=numpy.int64))
+
+        send = node.send
+        add = self.add
+        def timed_send(value=None):
+            start = time.perf_counter()
+            try:
+                return send(value)
+            finally:
+                add(stat, time.perf_counter() - start)
+        node.send = timed_send
+        return node
+
+    def record(self, name, latency, budget=None):
+        """Record latency of named task other than data nodes.
+
+        Parameters
+        ----------
+        name : str
+            The name of task.
+        latency : float
+            The latency to record.
+        budget : float, optional
+            The time budget of this task, default is the budget of profiler.
+        """
+        if name not in self.stats:
+            self.stats[name] = dict(calls=0, over=0, max=0.0, budget=budget,
+                                    hist=numpy.zeros(len(self.edges)+1, dtype=numpy.int64))
+        self.add(self.stats[name], latency)
+
+    def add(self, stat, latency):
+        stat["calls"] += 1
+        stat["hist"][numpy.searchsorted(self.edges, latency)] += 1
+        stat["max"] = max(stat["max"], latency)
+        budget = stat.get("budget") or self.budget
+        if budget is not None and latency > budget:
+            stat["over"] += 1
+
+    def percentile(self, name, q):
+        """Estimate percentile of latency by upper edge of histogram bins."""
+        stat = self.stats[name]
+        if stat["calls"] == 0:
+            return 0.0
+        index = numpy.searchsorted(numpy.cumsum(stat["hist"]), q/100 * stat["calls"])
+        return min(stat["max"], self.edges[min(index, len(self.edges)-1)])
+
+    def report(self):
+        """Format statistics as a table, sorted by 99th percentile latency."""
+        names = sorted(self.stats, key=lambda name: -self.percentile(name, 99))
+        width = max([len(name) for name in names] + [4])
+        lines = ["{:<{}s} {:>8s} {:>10s} {:>10s} {:>10s} {:>8s}".format(
+                 "node", width, "calls", "p50(ms)", "p99(ms)", "max(ms)", "over")]
+        if self.budget is not None:
+            lines.insert(0, "budget: {:.3f} ms".format(self.budget*1000))
+        for name in names:
+            stat = self.stats[name]
+            lines.append("{:<{}s} {:>8d} {:>10.3f} {:>10.3f} {:>10.3f} {:>8d}".format(
+                         name, width, stat["calls"],
+                         self.percentile(name, 50)*1000, self.percentile(name, 99)*1000,
+                         stat["max"]*1000, stat["over"]))
+        return "\n".join(lines)
+
+
+class RingBuffer:
+    """A fixed-length buffer with O(1) push and windowed views.
+
+    The items are stored twice in an array of double length, so that any
+    window of the latest `length` items is a contiguous view of the array,
+    and pushing never shifts the data.
+
+    Parameters
+    ----------
+    length : int
+        The number of items.
+    dtype : data-type, optional
+        The data type of items, default is `numpy.float32`.
+    fill : any, optional
+        The initial items, default is `0`.
+    """
+    def __init__(self, length, dtype=numpy.float32, fill=0):
+        self.length = length
+        self.buffer = numpy.empty(2*length, dtype=dtype)
+        self.buffer[:] = fill
+        self.index = 0 # index of the oldest item
+
+    def push(self, value):
+        """Push an item and return the popped oldest item."""
+        i = self.index
+        popped = self.buffer[i]
+        self.buffer[i] = self.buffer[i+self.length] = value
+        self.index = i + 1 if i + 1 < self.length else 0
+        return popped
+
+    def extend(self, data):
+        """Push items of given array."""
+        data = data[len(data)-self.length:] if len(data) > self.length else data
+        i, length, n = self.index, self.length, len(data)
+        m = min(n, length - i)
+        self.buffer[i:i+m] = self.buffer[i+length:i+length+m] = data[:m]
+        self.buffer[:n-m] = self.buffer[length:length+n-m] = data[m:]
+        self.index = (i + n) % length
+
+    def view(self, start=0, stop=None):
+        """The view of items `[start:stop]`, from the oldest to the latest.
+
+        The view is valid until the next push.
+        """
+        stop = self.length if stop is None else stop
+        return self.buffer[self.index+start:self.index+stop]
+
+class IntervalIndex:
+    """A static index of intervals, which finds intervals overlapping with given range.
+
+    It is a centered interval tree, so each query costs O(log n + k) for `n`
+    intervals and `k` results, and queries can be made in any order.
+
+    Parameters
+    ----------
+    intervals : list of tuple
+        The intervals composed by start/end time and data.
+    """
+    def __init__(self, intervals):
+        items = [(start, end, order, data) for order, (start, end, data) in enumerate(intervals)]
+        self.root = self.build(items)
+
+    @staticmethod
+    def build(items):
+        if not items:
+            return None
+        endpoints = sorted(point for start, end, _, _ in items for point in (start, end))
+        center = endpoints[len(endpoints)//2]
+
+        left = [item for item in items if item[1] < center]
+        right = [item for item in items if item[0] > center]
+        middle = [item for item in items if item[0] <= center <= item[1]]
+        by_start = sorted(middle, key=lambda item: item[0])
+        by_end = sorted(middle, key=lambda item: -item[1])
+
+        return (center, by_start, by_end, IntervalIndex.build(left), IntervalIndex.build(right))
+
+    def query(self, start, stop=None):
+        """Find data of intervals `(s, e)` such that `s < stop and e >= start`.
+
+        Parameters
+        ----------
+        start : float
+            The start of range.
+        stop : float, optional
+            The stop of range, default is equal to `start`.
+
+        Returns
+        -------
+        data : list
+            The found data, in the order of given intervals.
+        """
+        stop = start if stop is None else stop
+
+        found = []
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            if node is None:
+                continue
+            center, by_start, by_end, left, right = node
+
+            if stop <= center:
+                for item in by_start:
+                    if item[0] >= stop:
+                        break
+                    found.append(item)
+                nodes.append(left)
+
+            elif start > center:
+                for item in by_end:
+                    if item[1] < start:
+                        break
+                    found.append(item)
+                nodes.append(right)
+
+            else:
+                found.extend(by_start)
+                nodes.append(left)
+                nodes.append(right)
+
+        found.sort(key=lambda item: item[2])
+        return [item[3] for item in found]
+
 
 @DataNode.from_generator
 def delay(prepend):
@@ -113,11 +349,19 @@ def delay(prepend):
     data : any
         The delayed signal.
     """
-    buffer = [None]*prepend if isinstance(prepend, int) else list(prepend)
+    prepend = [None]*prepend if isinstance(prepend, int) else list(prepend)
+    if len(prepend) == 0:
+        data = yield
+        while True:
+            data = yield data
+
+    buffer = RingBuffer(len(prepend), dtype=object)
+    for value in prepend:
+        buffer.push(value)
+
     data = yield
     while True:
-        buffer.append(data)
-        data = yield buffer.pop(0)
+        data = yield buffer.push(data)
 
 @DataNode.from_generator
 def take(number):
@@ -321,9 +565,133 @@ def merge(*nodes):
         while True:
             data = yield (data, node.send())
 
+@DataNode.from_generator
+def prefetch(node, depth=4, on_underrun=None):
+    """A data node fetches data from given node in background thread.
+
+    The given node is run by a worker thread, which fills a bounded queue of
+    ready data, so that this node only dequeues data and never waits for the
+    worker, except for the first data, which is waited on entering (so the
+    given node can prepare, such as building cache of `load`, before streams
+    start).  If the queue runs dry, it yields silence instead.  The value
+    received by this node is forwarded to the given node (such as seeking
+    time of `load`), in which case the prefetched data are discarded, and
+    silence is yielded until the response arrives; the same number of
+    responded data are skipped, so that the data stay in sync with the
+    number of yielded buffers.
+
+    Parameters
+    ----------
+    node : DataNode
+        The data node to prefetch, which should produce ndarray.
+    depth : int, optional
+        The maximum number of prefetched data, default is `4`.
+    on_underrun : function, optional
+        The function called when the queue runs dry.
+
+    Receives
+    --------
+    value : any
+        The value to forward, or `None` to fetch next data.
+
+    Yields
+    ------
+    data : ndarray
+        The prefetched data, or zeros if the data is not ready.
+    """
+    node = DataNode.wrap(node)
+    buffer = queue.Queue(depth)
+    requests = queue.Queue()
+    stopped = threading.Event()
+    finished = object()
+    errors = []
+
+    # each forwarded value starts a new generation of data, so that the data
+    # prefetched before it can be recognized and discarded
+    def fetch():
+        generation = 0
+        try:
+            with node:
+                while not stopped.is_set():
+                    value = None
+                    with contextlib.suppress(queue.Empty):
+                        value = requests.get_nowait()
+                        generation += 1
+                    try:
+                        data = node.send(value)
+                    except StopIteration:
+                        break
+                    buffer.put((generation, data))
+        except BaseException as exc:
+            errors.append(exc)
+        finally:
+            # the consumer stops draining the queue after it is stopped
+            if not stopped.is_set():
+                buffer.put((generation, finished))
+
+    worker = threading.Thread(target=fetch, daemon=True)
+    worker.start()
+
+    try:
+        # wait for the first data, before any realtime callback
+        _, ready = buffer.get()
+        shape, dtype = (ready.shape, ready.dtype) if ready is not finished else ((0,), numpy.float32)
+
+        generation = 0
+        waiting = False
+        lag = 0
+        value = yield
+        while True:
+            if value is not None:
+                # discard data of previous generations, and count the buffers
+                # yielded until the response arrives
+                generation += 1
+                requests.put(value)
+                ready = ready if ready is finished else None
+                waiting = True
+                lag = 0
+
+            data, ready = ready, None
+            while data is None:
+                try:
+                    current, data = buffer.get_nowait()
+                except queue.Empty:
+                    break
+                if data is finished:
+                    break
+                if current != generation:
+                    data = None
+                elif lag:
+                    lag -= 1
+                    data = None
+
+            if data is finished:
+                break
+
+            if data is None:
+                data = numpy.zeros(shape, dtype=dtype)
+                if waiting:
+                    lag += 1
+                elif on_underrun is not None:
+                    on_underrun()
+            else:
+                waiting = False
+
+            value = yield data
+
+        if errors:
+            raise errors[0]
+
+    finally:
+        stopped.set()
+        # unblock the worker waiting for free space
+        with contextlib.suppress(queue.Empty):
+            while True:
+                buffer.get_nowait()
+        worker.join()
 
 @DataNode.from_generator
-def load(filename, buffer_length=1024, samplerate=44100, start=None, end=None):
+def load(filename, buffer_length=1024, samplerate=44100, start=None, end=None, cache=None, channels=1):
     """A data node to load sound file with given sample rate.
 
     Parameters
@@ -338,36 +706,84 @@ def load(filename, buffer_length=1024, samplerate=44100, start=None, end=None):
         The start time to load.
     end : float, optional
         The end time to load.
+    cache : str, optional
+        The directory of decoded signal cache, default is no caching.  With
+        caching, the file is decoded (and resampled) only once and the output
+        signals are copied from memory-mapped cache, `start`/`end`
+        are sample-accurate and can go beyond the file (padded by silence),
+        and it can seek to any time.
+    channels : int, optional
+        The number of channels of output signal, default is `1`.  The sound
+        file is mixed down or up to this number of channels.
+
+    Receives
+    --------
+    time : float or None
+        The time to seek to, which requires caching, or `None` to load next
+        signal.
 
     Yields
     ------
     data : ndarray
-        The loaded signal.
+        The loaded signal, which has shape `(buffer_length, channels)` for
+        multi-channel signal.
     """
+    if cache is not None:
+        signal = load_cache(filename, samplerate, cache, channels)
+
+        start_index = round(start * samplerate) if start is not None else 0
+        end_index = round(end * samplerate) if end is not None else len(signal)
+        stop_index = min(len(signal), end_index)
+
+        time = yield
+        index = start_index
+        while True:
+            if time is not None:
+                index = round(time * samplerate)
+            if index >= end_index:
+                return
+
+            if 0 <= index and index + buffer_length <= stop_index:
+                # copy out of memory map, so page faults happen here rather than in the consumer
+                data = numpy.array(signal[index:index+buffer_length])
+            else:
+                data = numpy.zeros((buffer_length,) + signal.shape[1:], dtype=numpy.float32)
+                i, j = max(0, index), min(stop_index, index+buffer_length)
+                if i < j:
+                    data[i-index:j-index] = signal[i:j]
+
+            index += buffer_length
+            time = yield data
+
     width = 2
     scale = 2.0 ** (1 - 8*width)
     fmt = "<i{:d}".format(width)
 
-    with audioread.audio_open(filename) as file:
-        if file.samplerate != samplerate:
-            raise ValueError("mismatch samplerate")
-
-        Dt = buffer_length / file.samplerate
+    with audioread.audio_open(filename) as file, contextlib.ExitStack() as stack:
+        Dt = buffer_length / samplerate
         start_index = round(start / Dt) if start is not None else None
         end_index = round(end / Dt) if end is not None else None
 
         def frombuffer(data):
             data = scale * numpy.frombuffer(data, fmt).astype(numpy.float32)
             if file.channels > 1:
-                data = data.reshape((-1, file.channels)).mean(axis=1)
-            return data
-        chunker = chunk(map(frombuffer, file), buffer_length)
+                data = data.reshape((-1, file.channels))
+            return remix(data, channels)
+        signals = map(frombuffer, file)
+
+        if file.samplerate != samplerate:
+            resampler = stack.enter_context(resample(file.samplerate, samplerate))
+            signals = (resampler.send(data) for data in itertools.chain(signals, [None]))
+
+        chunker = chunk(signals, buffer_length)
         chunker = nslice(chunker, start_index, end_index)
 
         with chunker:
-            yield
+            time = yield
             while True:
-                yield chunker.send()
+                if time is not None:
+                    raise ValueError("seeking requires cache")
+                time = yield chunker.send()
 
 @DataNode.from_generator
 def save(filename, samplerate=44100, width=2):
@@ -426,7 +842,7 @@ def empty(buffer_length=1024, samplerate=44100, duration=None):
             yield numpy.zeros(buffer_length, dtype=numpy.float32)
 
 @DataNode.from_generator
-def chunk(signals, buffer_length=1024):
+def chunk(signals, buffer_length=1024, batch=None):
     """A data node produces data by chunking given signal.
 
     Parameters
@@ -435,31 +851,113 @@ def chunk(signals, buffer_length=1024):
         The iterator of signal to chunk.
     buffer_length : int, optional
         The length of chunk, default is `1024`.
+    batch : int, optional
+        The number of chunks per block, default is no batching.
 
     Yields
     ------
     data : ndarray
-        The chunked signal with length `buffer_length`.
+        The chunked signal with length `buffer_length`, or the block of
+        chunks with shape `(batch, buffer_length)` in batch mode; the last
+        block may have fewer chunks.  Multi-channel signal with shape
+        `(length, channels)` is chunked along the first axis.
     """
-    buffer = numpy.zeros(buffer_length, dtype=numpy.float32)
+    size = buffer_length * (batch or 1)
+    shape = (lambda data: data.reshape((-1, buffer_length) + data.shape[1:])) if batch is not None else (lambda data: data)
+    buffer = None
     index = 0
 
     yield
     for data in signals:
+        if buffer is None:
+            buffer = numpy.zeros((size,) + data.shape[1:], dtype=numpy.float32)
         while data.shape[0] > 0:
-            length = min(buffer_length - index, data.shape[0])
+            length = min(size - index, data.shape[0])
             buffer[index:index+length] = data[:length]
             index += length
             data = data[length:]
 
-            if index == buffer_length:
-                yield numpy.copy(buffer)
+            if index == size:
+                yield shape(numpy.copy(buffer))
                 index = 0
 
     else:
         if index > 0:
             buffer[index:] = 0.0
-            yield numpy.copy(buffer)
+            yield shape(numpy.copy(buffer[:-(-index // buffer_length) * buffer_length]))
+
+@DataNode.from_generator
+def resample(from_samplerate, to_samplerate):
+    """A data node resamples signal by streaming polyphase filtering.
+
+    It uses the same anti-aliasing filter as `scipy.signal.resample_poly`,
+    and the concatenated output is equal to resampling whole signal at once.
+
+    Parameters
+    ----------
+    from_samplerate : int
+        The sample rate of input signal.
+    to_samplerate : int
+        The sample rate of output signal.
+
+    Receives
+    --------
+    data : ndarray or None
+        The input signal, or `None` to flush the remaining output.  The
+        multi-channel signal has shape `(length, channels)`.
+
+    Yields
+    ------
+    data : ndarray
+        The resampled signal, whose length may vary.
+    """
+    gcd = math.gcd(from_samplerate, to_samplerate)
+    up = to_samplerate // gcd
+    down = from_samplerate // gcd
+
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    h = scipy.signal.firwin(2*half_len+1, 1.0/max_rate, window=("kaiser", 5.0)) * up
+    taps = -(-len(h) // up)
+    h = numpy.concatenate((h, numpy.zeros(taps*up - len(h))))
+    # polyphase components: phases[p, i] == h[p + up*i]
+    phases = h.reshape(taps, up).T
+    offsets = numpy.arange(taps)
+
+    history = None
+    received = 0 # number of received samples
+    index = 0 # index of next output sample
+    stop = None
+
+    data = yield
+    while True:
+        if history is None:
+            channels = data.shape[1:] if data is not None else ()
+            history = numpy.zeros((taps-1,) + channels, dtype=numpy.float32)
+            coeffs = phases.reshape(phases.shape + (1,)*len(channels))
+
+        if data is None:
+            # flush by zero padding, and cut off at the expected length
+            if stop is None:
+                stop = -(-received*up // down)
+            data = numpy.zeros((half_len//up + taps,) + channels, dtype=numpy.float32)
+
+        signal = numpy.concatenate((history, data))
+        received += len(data)
+        first = received - len(signal) # sample index of signal[0]
+
+        index_end = max(index, (received*up - 1 - half_len) // down + 1)
+        if stop is not None:
+            index_end = min(index_end, stop)
+
+        n = numpy.arange(index, index_end) * down + half_len
+        base, phase = numpy.divmod(n, up)
+        samples = signal[(base - first)[:, None] - offsets[None, :]]
+        output = (coeffs[phase] * samples).sum(axis=1).astype(numpy.float32)
+        index = index_end
+
+        history = signal[len(signal)-(taps-1):]
+        data = yield output
 
 @DataNode.from_generator
 def drip(signals, schedule):
@@ -475,28 +973,22 @@ def drip(signals, schedule):
 
     Receives
     --------
-    time : float
-        The current time to fetch signals, which should greater than previous received time.
+    time : float or tuple
+        The current time to fetch signals, which can move forward or backward.
+        It can also be a time range `(start, stop)` to fetch signals overlapping with it.
 
     Yields
     ------
     data : list
-        The signals occurred in the given time.
+        The signals occurred in the given time, ordered by their schedule.
     """
-    it = iter(sorted((schedule(data), data) for data in signals))
-
-    buffer = []
-    waiting = next(it, None)
+    scheduled = sorted(((schedule(data), data) for data in signals), key=lambda item: item[0])
+    index = IntervalIndex([(start, end, data) for (start, end), data in scheduled])
 
     time = yield
     while True:
-        while waiting is not None and waiting[0][0] < time:
-            buffer.append(waiting)
-            waiting = next(it, None)
-
-        buffer = [playing for playing in buffer if playing[0][1] >= time]
-
-        time = yield [data for _, data in buffer]
+        start, stop = time if isinstance(time, tuple) else (time, time)
+        time = yield index.query(start, stop)
 
 @DataNode.from_generator
 def attach(scheduled_signals, buffer_length=1024, samplerate=44100):
@@ -514,7 +1006,7 @@ def attach(scheduled_signals, buffer_length=1024, samplerate=44100):
     Receives
     --------
     data : ndarray
-        The input signal.
+        The input signal, or the block of signals with shape `(N, buffer_length)`.
 
     Yields
     ------
@@ -523,17 +1015,25 @@ def attach(scheduled_signals, buffer_length=1024, samplerate=44100):
     """
     def schedule(item):
         time, data = item
-        return (int(time*samplerate) - buffer_length, int(time*samplerate) + len(data))
+        return (int(time*samplerate), int(time*samplerate) + len(data))
     dripping_signals = drip(scheduled_signals, schedule)
 
     with dripping_signals:
         buffer = yield
-        for index in itertools.count(0, buffer_length):
-            for time, signal in dripping_signals.send(index):
+        index = 0
+        while True:
+            if not buffer.flags.writeable:
+                buffer = numpy.copy(buffer)
+            data = buffer.reshape(-1)
+            length = len(data)
+
+            for time, signal in dripping_signals.send((index, index+length)):
                 start = int(time*samplerate)
                 i = max(start, index)
-                j = min(start+len(signal), index+buffer_length)
-                buffer[i-index:j-index] += signal[i-start:j-start]
+                j = min(start+len(signal), index+length)
+                data[i-index:j-index] += signal[i-start:j-start]
+
+            index += length
             buffer = yield buffer
 
 
@@ -551,19 +1051,27 @@ def frame(win_length, hop_length):
     Receives
     --------
     data : ndarray
-        The input signal.
+        The input signal, or the block of signals with shape `(N, hop_length)`.
 
     Yields
     ------
     data : ndarray
-        The framed signal.
+        The framed signal, or the block of framed signals with shape
+        `(N, win_length)`, which is a view valid until next period.
     """
-    data = numpy.zeros(win_length, dtype=numpy.float32)
-    data[-hop_length:] = yield
+    buffer = RingBuffer(win_length)
+    data = yield
     while True:
-        data_last = yield numpy.copy(data)
-        data[:-hop_length] = data[hop_length:]
-        data[-hop_length:] = data_last
+        if data.ndim == 1:
+            buffer.extend(data)
+            data = yield buffer.view()
+
+        else:
+            signal = numpy.concatenate((buffer.view(), data.reshape(-1)))
+            frames = numpy.lib.stride_tricks.sliding_window_view(signal, win_length)
+            frames = frames[hop_length::hop_length][:len(data)]
+            buffer.extend(signal)
+            data = yield frames
 
 @DataNode.from_generator
 def power_spectrum(win_length, samplerate=44100, windowing=True, weighting=True):
@@ -589,22 +1097,36 @@ def power_spectrum(win_length, samplerate=44100, windowing=True, weighting=True)
     Receives
     --------
     x : ndarray
-        The input signal.
+        The input signal, or the block of signals with shape `(N, win_length)`.
 
     Yields
     ------
     J : ndarray
-        The power spectrum, with length `win_length//2+1`.
+        The power spectrum, with length `win_length//2+1`, or the block of
+        power spectra with shape `(N, win_length//2+1)`.  The single power
+        spectrum is written to the same buffer in each period.
     """
     if isinstance(windowing, bool):
         windowing = get_Hann_window(win_length) if windowing else 1
     if isinstance(weighting, bool):
         weighting = get_A_weight(samplerate, win_length) if weighting else 1
-    weighting *= 2/win_length/samplerate
+    weighting = weighting * (2/win_length/samplerate)
+
+    windowed = numpy.empty(win_length, dtype=numpy.float64)
+    J = numpy.empty(win_length//2+1, dtype=numpy.float64)
 
     x = yield
     while True:
-        x = yield weighting * numpy.abs(numpy.fft.rfft(x*windowing))**2
+        if x.ndim == 1:
+            numpy.multiply(x, windowing, out=windowed)
+            spec = scipy.fft.rfft(windowed, overwrite_x=True)
+            numpy.abs(spec, out=J)
+            numpy.square(J, out=J)
+            numpy.multiply(J, weighting, out=J)
+            x = yield J
+
+        else:
+            x = yield numpy.abs(scipy.fft.rfft(x*windowing, axis=-1))**2 * weighting
 
 @DataNode.from_generator
 def onset_strength(df):
@@ -618,17 +1140,28 @@ def onset_strength(df):
     Receives
     --------
     J : ndarray
-        Input spectrum.
+        Input spectrum, or the block of spectra with shape `(N, n_fft)`.
 
     Yields
     ------
-    st : float
-        The onset strength between previous and current input spectrum.
+    st : float or ndarray
+        The onset strength between previous and current input spectrum,
+        or the block of onset strengths with shape `(N,)`.
     """
     curr = yield
-    prev = numpy.zeros_like(curr)
+    prev = numpy.zeros(curr.shape[-1], dtype=curr.dtype)
+    diff = numpy.empty_like(prev)
     while True:
-        prev, curr = curr, (yield numpy.maximum(0.0, curr - prev).sum(0) * df)
+        if curr.ndim == 1:
+            numpy.subtract(curr, prev, out=diff)
+            numpy.maximum(diff, 0.0, out=diff)
+            st = diff.sum(0) * df
+            prev[:] = curr
+        else:
+            diffs = numpy.diff(curr, axis=0, prepend=prev[None, :])
+            st = numpy.maximum(0.0, diffs).sum(1) * df
+            prev[:] = curr[-1]
+        curr = yield st
 
 @DataNode.from_generator
 def pick_peak(pre_max, post_max, pre_avg, post_avg, wait, delta):
@@ -645,35 +1178,53 @@ def pick_peak(pre_max, post_max, pre_avg, post_avg, wait, delta):
 
     Receives
     --------
-    y : float
-        The input signal.
+    y : float or ndarray
+        The input signal, or the block of signals with shape `(N,)`.
 
     Yields
     ------
-    detected : bool
-        Whether the signal reaches its peak.
+    detected : bool or ndarray
+        Whether the signal reaches its peak, or the block of results with shape `(N,)`.
     """
     center = max(pre_max, pre_avg)
     delay = max(post_max, post_avg)
-    buffer = numpy.zeros(center+delay+1, dtype=numpy.float32)
-    max_buffer = buffer[center-pre_max:center+post_max+1]
-    avg_buffer = buffer[center-pre_avg:center+post_avg+1]
+    buffer = RingBuffer(center+delay+1)
     index = -delay
     prev_index = -wait
 
-    buffer[-1] = yield
+    y = yield
     while True:
-        index += 1
-        strength = buffer[center]
-        detected = True
-        detected = detected and index > prev_index + wait
-        detected = detected and strength == max_buffer.max()
-        detected = detected and strength >= avg_buffer.mean() + delta
-
-        if detected:
-            prev_index = index
-        buffer[:-1] = buffer[1:]
-        buffer[-1] = yield detected
+        if numpy.ndim(y) == 0:
+            buffer.push(y)
+            index += 1
+            strength = buffer.view(center, center+1)[0]
+            detected = True
+            detected = detected and index > prev_index + wait
+            detected = detected and strength == buffer.view(center-pre_max, center+post_max+1).max()
+            detected = detected and strength >= buffer.view(center-pre_avg, center+post_avg+1).mean() + delta
+
+            if detected:
+                prev_index = index
+            y = yield detected
+
+        else:
+            signal = numpy.concatenate((buffer.view(), numpy.asarray(y, dtype=numpy.float32)))
+            windows = numpy.lib.stride_tricks.sliding_window_view(signal, buffer.length)[1:]
+            strength = windows[:, center]
+            detected = strength == windows[:, center-pre_max:center+post_max+1].max(axis=1)
+            detected &= strength >= windows[:, center-pre_avg:center+post_avg+1].mean(axis=1) + delta
+
+            # apply waiting sequentially, only on candidates
+            indices = index + 1 + numpy.arange(len(y))
+            for i in numpy.flatnonzero(detected):
+                if indices[i] > prev_index + wait:
+                    prev_index = indices[i]
+                else:
+                    detected[i] = False
+
+            index += len(y)
+            buffer.extend(signal)
+            y = yield detected
 
 @DataNode.from_generator
 def draw_spectrum(length, win_length, samplerate=44100, decay=1.0):
@@ -743,6 +1294,13 @@ def record(manager, node, buffer_length=1024, samplerate=44100, format="f4", cha
     ------
     input_stream : pyaudio.Stream
         The stopped input stream to record sound.
+
+    Notes
+    -----
+    The signal sent to the node is converted in a buffer reused by every
+    callback, so it is only valid during the call.  The multi-channel
+    signal is sent as a view with shape `(buffer_length, channels)` of the
+    interleaved buffer.
     """
     pa_format = {"f4": pyaudio.paFloat32,
                  "i4": pyaudio.paInt32,
@@ -751,18 +1309,27 @@ def record(manager, node, buffer_length=1024, samplerate=44100, format="f4", cha
                  "u1": pyaudio.paUInt8,
                  }[format]
 
-    scale = 2.0 ** (8*int(format[1]) - 1)
-    normalize = {"f4": (lambda d: d),
-                 "i4": (lambda d: d / scale),
-                 "i2": (lambda d: d / scale),
-                 "i1": (lambda d: d / scale),
-                 "u1": (lambda d: (d - 128)/128),
-                 }[format]
+    # convert in place, to avoid allocation in the realtime thread
+    buffer = numpy.zeros(buffer_length*channels, dtype=numpy.float32)
+    scale = numpy.float32(2.0 ** (1 - 8*int(format[1])))
+    def normalize(d):
+        if format == "f4":
+            return d
+        out = buffer if len(d) == len(buffer) else buffer[:len(d)]
+        numpy.copyto(out, d, casting="unsafe")
+        if format == "u1":
+            out -= 128
+            out /= 128
+        else:
+            out *= scale
+        return out
 
     def input_callback(in_data, frame_count, time_info, status):
         try:
             data = numpy.frombuffer(in_data, dtype=format)
             data = normalize(data)
+            if channels > 1:
+                data = data.reshape(-1, channels)
             node.send(data)
 
             return b'', pyaudio.paContinue
@@ -787,7 +1354,7 @@ def record(manager, node, buffer_length=1024, samplerate=44100, format="f4", cha
             input_stream.close()
 
 @contextlib.contextmanager
-def play(manager, node, buffer_length=1024, samplerate=44100, format="f4", channels=1, device=None):
+def play(manager, node, buffer_length=1024, samplerate=44100, format="f4", channels=1, device=None, clock=None):
     """A context manager of output stream processing by given node.
 
     Parameters
@@ -806,11 +1373,21 @@ def play(manager, node, buffer_length=1024, samplerate=44100, format="f4", chann
         The number of channels of output signal, default is `1`.
     device : int, optional
         The output device index.
+    clock : StreamClock, optional
+        The clock to synchronize with played samples.
 
     Yields
     ------
     output_stream : pyaudio.Stream
         The stopped output stream to play sound.
+
+    Notes
+    -----
+    The signal from the node is converted in buffers reused by every
+    callback, and handed to PortAudio without copying into bytes.  The node
+    can produce signal with any number of channels, with shape
+    `(buffer_length, channels)` for multi-channel signal, which is mixed
+    down or up to the channels of stream.
     """
     pa_format = {"f4": pyaudio.paFloat32,
                  "i4": pyaudio.paInt32,
@@ -819,19 +1396,37 @@ def play(manager, node, buffer_length=1024, samplerate=44100, format="f4", chann
                  "u1": pyaudio.paUInt8,
                  }[format]
 
-    scale = 2.0 ** (8*int(format[1]) - 1)
-    normalize = {"f4": (lambda d: d),
-                 "i4": (lambda d: d * scale),
-                 "i2": (lambda d: d * scale),
-                 "i1": (lambda d: d * scale),
-                 "u1": (lambda d: d * 128 + 128),
-                 }[format]
+    # convert in place, to avoid allocation in the realtime thread
+    buffer = numpy.zeros(buffer_length*channels, dtype=numpy.float32)
+    output = numpy.zeros(buffer_length*channels, dtype=format)
+    scale = numpy.float32(2.0 ** (8*int(format[1]) - 1))
+    def normalize(d):
+        if channels > 1 or d.ndim > 1:
+            frames = buffer.reshape(-1, channels) if channels > 1 else buffer
+            d = remix(d, channels, out=frames[:len(d)])
+            d = d.reshape(-1)
+        if format == "f4" and d.dtype == numpy.float32 and d.flags.c_contiguous:
+            return d
+        work = buffer if len(d) == len(buffer) else buffer[:len(d)]
+        out = output if len(d) == len(output) else output[:len(d)]
+        if format == "f4":
+            numpy.copyto(out, d, casting="unsafe")
+        elif format == "u1":
+            numpy.multiply(d, numpy.float32(128), out=work)
+            work += 128
+            numpy.copyto(out, work, casting="unsafe")
+        else:
+            numpy.multiply(d, scale, out=work)
+            numpy.copyto(out, work, casting="unsafe")
+        return out
 
     def output_callback(in_data, frame_count, time_info, status):
         try:
+            if clock is not None:
+                clock.sync(frame_count, time_info)
             data = node.send(None)
-            data = normalize(data).astype(format)
-            return data.tobytes(), pyaudio.paContinue
+            data = normalize(data)
+            return data, pyaudio.paContinue
         except StopIteration:
             return b'', pyaudio.paComplete
 
@@ -872,7 +1467,146 @@ def collect(node):
                 buffer.append(node.send())
     return numpy.concatenate(buffer)
 
-def loop(node, dt, until=lambda: False):
+class Ticker:
+    """A scheduler of periodic tasks with absolute deadlines.
+
+    The deadlines are fixed on the grid of given time interval, so the time
+    spent by the task doesn't add to the period.  If it falls behind more
+    than one period, the missed periods are dropped instead of piling up.
+
+    Parameters
+    ----------
+    dt : float
+        The time interval of each period.
+    smoothing : float, optional
+        The smoothing factor of exponential moving average of statistics.
+
+    Attributes
+    ----------
+    fps : float
+        The actual number of periods per second.
+    jitter : float
+        The mean lateness of ticks to their deadlines.
+    frames : int
+        The number of ticks.
+    dropped : int
+        The number of dropped periods.
+    """
+    def __init__(self, dt, smoothing=0.05):
+        self.smoothing = smoothing
+        self.frames = 0
+        self.dropped = 0
+        self.reset(dt)
+
+    def reset(self, dt=None):
+        """Restart deadlines from now, and change time interval if given."""
+        if dt is not None:
+            self.dt = dt
+        self.deadline = None
+        self.last_tick = None
+        self.fps = 1/self.dt
+        self.jitter = 0.0
+
+    def wait(self):
+        """Sleep until next deadline."""
+        now = time.perf_counter()
+        if self.deadline is None:
+            self.deadline = now
+        else:
+            self.deadline += self.dt
+            if now > self.deadline + self.dt:
+                missed = int((now - self.deadline) / self.dt)
+                self.deadline += missed * self.dt
+                self.dropped += missed
+            if self.deadline > now:
+                time.sleep(self.deadline - now)
+
+        tick = time.perf_counter()
+        a = self.smoothing
+        self.jitter += a * (max(0.0, tick - self.deadline) - self.jitter)
+        if self.last_tick is not None and tick > self.last_tick:
+            self.fps += a * (1/(tick - self.last_tick) - self.fps)
+            if Profiler.current is not None:
+                Profiler.current.record("loop.period", tick - self.last_tick, self.dt*1.5)
+        self.last_tick = tick
+        self.frames += 1
+
+class StreamClock:
+    """A clock of audio stream, counted by samples reaching the speaker.
+
+    The output callback reports its buffer by `sync`, with the time the
+    first sample of buffer will be played by DAC.  Between callbacks, the
+    time is interpolated by the local clock, and it never goes backward or
+    ahead of the samples already delivered.
+
+    Parameters
+    ----------
+    samplerate : int
+        The sample rate of stream.
+    latency : float, optional
+        The output latency used when the stream doesn't report DAC time.
+    smoothing : float, optional
+        The smoothing factor of the offset between local clock and stream.
+
+    Attributes
+    ----------
+    position : int
+        The number of samples delivered to stream.
+    offset : float
+        The local time at which the stream time is zero.
+    """
+    def __init__(self, samplerate, latency=0.0, smoothing=0.1):
+        self.samplerate = samplerate
+        self.latency = latency
+        self.smoothing = smoothing
+        self.position = 0
+        self.offset = None
+        self.last = 0.0
+
+    def sync(self, frame_count, time_info):
+        """Record a buffer of `frame_count` samples delivered to stream."""
+        now = time.perf_counter()
+        dac_time = time_info.get("output_buffer_dac_time", 0.0) if time_info else 0.0
+        current_time = time_info.get("current_time", 0.0) if time_info else 0.0
+        if dac_time > 0.0 and current_time > 0.0 and 0.0 <= dac_time - current_time < 1.0:
+            delay = dac_time - current_time
+        else:
+            delay = self.latency
+
+        offset = now + delay - self.position / self.samplerate
+        if self.offset is None:
+            self.offset = offset
+        else:
+            self.offset += self.smoothing * (offset - self.offset)
+        self.position += frame_count
+
+    def pause(self):
+        """Freeze the clock until next buffer is delivered to stream."""
+        self.time()
+        self.offset = None
+
+    def time(self, now=None):
+        """The current time of stream in seconds.
+
+        Parameters
+        ----------
+        now : float, optional
+            The local time given by `time.perf_counter`.
+
+        Returns
+        -------
+        time : float
+            The time of sample being played, `0.0` before any buffer is played.
+        """
+        if self.offset is None:
+            return self.last
+        if now is None:
+            now = time.perf_counter()
+        t = min(now - self.offset, self.position / self.samplerate)
+        self.last = max(self.last, t)
+        return self.last
+
+def loop(node, dt, until=lambda: False, ticker=None):
     """Loop data node with given time interval.
 
     Parameters
@@ -883,14 +1617,188 @@ def loop(node, dt, until=lambda: False):
         The time interval of each period.
     until : function, optional
         The condition to stop looping.
+    ticker : Ticker, optional
+        The scheduler of periods, default is a new one with interval `dt`.
     """
+    if ticker is None:
+        ticker = Ticker(dt)
+
     with node:
         with contextlib.suppress(StopIteration):
             while not until():
+                ticker.wait()
                 node.send()
-                time.sleep(dt)
 
 
+def decode(filename, samplerate=44100, channels=1):
+    """Decode whole sound file into signal.
+
+    Parameters
+    ----------
+    filename : str
+        The sound file to decode.
+    samplerate : int, optional
+        The sample rate of decoded signal, default is `44100`.
+    channels : int, optional
+        The number of channels of decoded signal, default is `1`.
+
+    Returns
+    -------
+    signal : ndarray
+        The decoded signal with dtype float32, which has shape
+        `(length, channels)` for multi-channel signal.
+    """
+    width = 2
+    scale = 2.0 ** (1 - 8*width)
+    fmt = "<i{:d}".format(width)
+
+    with audioread.audio_open(filename) as file:
+        data = numpy.frombuffer(b"".join(file), fmt)
+        signal = (scale * data).astype(numpy.float32)
+        if file.channels > 1:
+            signal = signal.reshape((-1, file.channels))
+        signal = remix(signal, channels)
+
+        if file.samplerate != samplerate:
+            gcd = math.gcd(file.samplerate, samplerate)
+            signal = scipy.signal.resample_poly(signal, samplerate // gcd, file.samplerate // gcd, axis=0)
+            signal = signal.astype(numpy.float32)
+
+        return signal
+
+@contextlib.contextmanager
+def atomic_open(filename, mode="wb"):
+    """Open a file for writing, which replaces given file only when it is completely written.
+
+    The content is written to a unique temporary file next to `filename`, so
+    readers never see a partially written file and concurrent writers don't
+    clobber each other, and it is removed if writing fails.
+
+    Parameters
+    ----------
+    filename : str
+        The file to write.
+    mode : str, optional
+        The mode to open the temporary file, default is `"wb"`.
+
+    Yields
+    ------
+    file : file object
+        The opened temporary file.
+    """
+    directory, name = os.path.split(filename)
+    os.makedirs(directory or ".", exist_ok=True)
+    fd, temp_filename = tempfile.mkstemp(prefix=name + ".", suffix=".tmp", dir=directory or ".")
+    try:
+        with os.fdopen(fd, mode) as file:
+            yield file
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_filename)
+        raise
+    os.replace(temp_filename, filename)
+
+def get_cache_filename(filename, samplerate, cache, channels=1):
+    """Get the filename of decoded signal cache used by `load_cache`.
+
+    Parameters
+    ----------
+    filename : str
+        The sound file.
+    samplerate : int
+        The sample rate of decoded signal.
+    cache : str
+        The directory of cache.
+    channels : int, optional
+        The number of channels of decoded signal, default is `1`.
+
+    Returns
+    -------
+    cache_filename : str
+        The .npy file of cache, which may not exist yet.
+    """
+    path = os.path.abspath(filename)
+    key = "{}:{!r}:{}".format(path, os.path.getmtime(path), samplerate)
+    if channels != 1:
+        key += ":{}".format(channels)
+    key = hashlib.sha1(key.encode("utf8")).hexdigest()
+    return os.path.join(cache, key + ".npy")
+
+def load_cache(filename, samplerate, cache, channels=1):
+    """Load decoded sound file from cache, decode it if there is no cache.
+
+    The cache is a .npy file keyed by path, mtime, sample rate and channels
+    of sound file, which is loaded as read-only memory map.
+
+    Parameters
+    ----------
+    filename : str
+        The sound file to load.
+    samplerate : int
+        The sample rate of decoded signal.
+    cache : str
+        The directory of cache.
+    channels : int, optional
+        The number of channels of decoded signal, default is `1`.
+
+    Returns
+    -------
+    signal : numpy.memmap
+        The decoded signal with dtype float32.
+    """
+    cache_filename = get_cache_filename(filename, samplerate, cache, channels)
+
+    if not os.path.exists(cache_filename):
+        signal = decode(filename, samplerate, channels)
+        with atomic_open(cache_filename) as file:
+            numpy.save(file, signal)
+
+    return numpy.load(cache_filename, mmap_mode="r")
+
+def remix(signal, channels=1, weights=None, out=None):
+    """Mix signal down or up to given number of channels.
+
+    Parameters
+    ----------
+    signal : ndarray
+        The mono signal, or the multi-channel signal with shape
+        `(length, channels)`.
+    channels : int, optional
+        The number of channels to mix into, default is `1`.
+    weights : ndarray, optional
+        The weights of channels to mix down, default is average.
+    out : ndarray, optional
+        The array to store mixed signal.
+
+    Returns
+    -------
+    signal : ndarray
+        The mixed signal, which is mono for `channels == 1`, or has shape
+        `(length, channels)`.  It is the given signal if nothing to mix.
+        Mixing between different numbers of channels goes through a
+        temporary mono signal.
+    """
+    if signal.ndim > 1 and (signal.shape[1] != channels or weights is not None):
+        # mix down
+        if channels == 1 and out is not None:
+            mono = out
+        else:
+            mono = numpy.empty(len(signal), dtype=numpy.float32)
+        if weights is None:
+            numpy.mean(signal, axis=1, out=mono)
+        else:
+            numpy.dot(signal, weights, out=mono)
+        signal = mono
+
+    if signal.ndim == 1 and channels > 1:
+        # mix up
+        if out is None:
+            out = numpy.empty((len(signal), channels), dtype=numpy.float32)
+        numpy.copyto(out, signal[:, None])
+        signal = out
+
+    return signal
+
 def filter(x, distr):
     return numpy.fft.irfft(numpy.fft.rfft(x) * distr)
 
@@ -900,15 +1808,61 @@ def pulse(samplerate=44100, freq=1000.0, decay_time=0.01, amplitude=1.0, length=
     t = numpy.linspace(0, length, int(length*samplerate), endpoint=False, dtype=numpy.float32)
     return amplitude * 2**(-t/decay_time) * numpy.sin(2 * numpy.pi * freq * t)
 
+def scatter(signal, times, samplerate=44100, length=None, out=None):
+    """Place copies of signal at given times, overlapping parts are summed.
+
+    Parameters
+    ----------
+    signal : ndarray
+        The signal to place.
+    times : list of float
+        The start times of copies.
+    samplerate : int, optional
+        The sample rate, default is `44100`.
+    length : int, optional
+        The length of output signal, default is long enough to contain all copies.
+    out : ndarray, optional
+        The signal to add copies into (in place), which determines `length`.
+
+    Returns
+    -------
+    data : ndarray
+        The output signal with dtype float32.
+    """
+    starts = (numpy.asarray(times, dtype=float) * samplerate).astype(int)
+    if out is not None:
+        data = out
+        length = len(out)
+    else:
+        if length is None:
+            length = starts.max() + len(signal) if len(starts) > 0 else 0
+        data = numpy.zeros(length, dtype=numpy.float32)
+
+    for start in starts.tolist():
+        i, j = max(0, start), min(length, start + len(signal))
+        if i < j:
+            data[i:j] += signal[i-start:j-start]
+    return data
+
 def power2db(power, scale=(1e-5, 1e6)):
     return 10.0 * numpy.log10(numpy.maximum(scale[0], power*scale[1]))
 
+@functools.lru_cache(maxsize=None)
 def get_Hann_window(win_length):
     a = numpy.linspace(0, numpy.pi, win_length)
     window = numpy.sin(a)**2
     gain = (3/8)**0.5 # (window**2).mean()**0.5
-    return window / gain
+    window /= gain
+    window.flags.writeable = False
+    return window
+
+@functools.lru_cache(maxsize=None)
+def get_half_Hann_window(win_length):
+    window = numpy.sin(numpy.linspace(0, numpy.pi/2, win_length))**2
+    window.flags.writeable = False
+    return window
 
+@functools.lru_cache(maxsize=None)
 def get_A_weight(samplerate, win_length):
     f = numpy.arange(win_length//2+1) * (samplerate/win_length)
 
@@ -935,5 +1889,6 @@ def get_A_weight(samplerate, win_length):
     weight[f<10] = 0.0
     weight[f>20000] = 0.0
 
+    weight.flags.writeable = False
     return weight
 
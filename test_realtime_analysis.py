@@ -0,0 +1,112 @@
+import numpy
+import realtime_analysis as ra
+
+
+WIN_LENGTH = 512*4
+HOP_LENGTH = 512
+SAMPLERATE = 44100
+
+
+def get_detector():
+    return ra.pipe(ra.frame(WIN_LENGTH, HOP_LENGTH),
+                   ra.power_spectrum(WIN_LENGTH, samplerate=SAMPLERATE),
+                   ra.onset_strength(1))
+
+def get_signal(count, seed=0):
+    rng = numpy.random.default_rng(seed)
+    signal = rng.normal(0.0, 1e-3, count*HOP_LENGTH).astype(numpy.float32)
+    for start in rng.integers(0, len(signal) - 1000, 20):
+        signal[start:start+1000] += rng.normal(0.0, 0.5, 1000).astype(numpy.float32)
+    return signal.reshape(count, HOP_LENGTH)
+
+def test_streaming_and_batch_are_equal():
+    signal = get_signal(200)
+
+    with get_detector() as detector:
+        streaming = numpy.array([detector.send(data) for data in signal])
+
+    with get_detector() as detector:
+        batch = detector.send(signal)
+
+    assert batch.shape == streaming.shape
+    assert numpy.allclose(streaming, batch)
+
+def test_batch_blocks_carry_state():
+    signal = get_signal(200)
+
+    with get_detector() as detector:
+        whole = detector.send(signal)
+
+    with get_detector() as detector:
+        blocks = numpy.concatenate([detector.send(signal[i:i+64]) for i in range(0, len(signal), 64)])
+
+    assert numpy.allclose(whole, blocks)
+
+def test_batch_then_streaming_are_equal():
+    signal = get_signal(200)
+
+    with get_detector() as detector:
+        streaming = numpy.array([detector.send(data) for data in signal])
+
+    with get_detector() as detector:
+        mixed = numpy.concatenate([detector.send(signal[:100]), [detector.send(data) for data in signal[100:]]])
+
+    assert mixed.shape == streaming.shape
+    assert numpy.allclose(streaming, mixed)
+
+def test_pick_peak_batch_and_streaming_are_equal():
+    with get_detector() as detector:
+        strength = detector.send(get_signal(200))
+
+    with ra.pick_peak(3, 3, 3, 3, 3, 1e-4) as picker:
+        streaming = numpy.array([picker.send(y) for y in strength.tolist()])
+
+    with ra.pick_peak(3, 3, 3, 3, 3, 1e-4) as picker:
+        mixed = numpy.concatenate([picker.send(strength[:64]), picker.send(strength[64:128]),
+                                   [picker.send(y) for y in strength[128:].tolist()]])
+
+    assert streaming.any()
+    assert mixed.shape == streaming.shape
+    assert (mixed == streaming).all()
+
+def test_attach_batch_and_streaming_are_equal():
+    sound = numpy.linspace(1.0, 0.0, 1000, dtype=numpy.float32)
+    scheduled = [(0.01, sound), (0.5, sound), (1.0, sound), (1.01, sound)]
+    signal = get_signal(200)
+
+    with ra.attach(scheduled, buffer_length=HOP_LENGTH, samplerate=SAMPLERATE) as attacher:
+        streaming = numpy.array([attacher.send(numpy.copy(data)) for data in signal])
+
+    with ra.attach(scheduled, buffer_length=HOP_LENGTH, samplerate=SAMPLERATE) as attacher:
+        mixed = numpy.concatenate([attacher.send(numpy.copy(signal[:64])),
+                                   [attacher.send(numpy.copy(data)) for data in signal[64:]]])
+
+    expected = numpy.copy(signal).reshape(-1)
+    for time, data in scheduled:
+        start = int(time*SAMPLERATE)
+        expected[start:start+len(data)] += data
+
+    assert numpy.allclose(streaming.reshape(-1), expected)
+    assert numpy.allclose(mixed.reshape(-1), expected)
+
+def drain(node):
+    results = []
+    with node:
+        try:
+            while True:
+                results.append(node.send())
+        except StopIteration:
+            pass
+    return results
+
+def test_chunk_batch_and_streaming_are_equal():
+    signal = get_signal(200).reshape(-1)
+    pieces = [signal[:1000], signal[1000:1001], signal[1001:50000], signal[50000:-100]]
+
+    streaming = drain(ra.chunk(pieces, buffer_length=HOP_LENGTH))
+    batch = drain(ra.chunk(pieces, buffer_length=HOP_LENGTH, batch=64))
+
+    assert all(data.shape == (HOP_LENGTH,) for data in streaming)
+    assert all(block.shape[1:] == (HOP_LENGTH,) for block in batch)
+    assert numpy.array_equal(numpy.array(streaming), numpy.concatenate(batch))
+    assert numpy.array_equal(numpy.concatenate(streaming)[:len(signal)-100], signal[:-100])